@@ -0,0 +1,321 @@
+"""Load test and benchmark for functions/main.py's generate_username, without Gemini quota.
+
+`google.generativeai` is replaced by a stub with configurable latency, error rate
+and output, then the function is driven through a Flask test client (or a local
+HTTP server with --http) at several concurrency levels. Reported per level:
+requests/sec, p50/p95/p99 latency, status counts and model calls (the prompt cache
+stays warm between levels unless --reset-cache is given). Also reported:
+cold-start import time of main.py (in fresh interpreters, real dependencies) and
+per-request allocations (tracemalloc, sequential). Results are written as JSON so
+runs can be compared between changes.
+
+    python benchmarks/bench_generate_username.py --concurrency 1 8 32 --requests 2000 \
+        --latency-ms 400 --error-rate 0.01 --output bench_generate_username.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions')
+sys.path.insert(0, FUNCTIONS_DIR)
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubGemini:
+    """Stands in for the `google.generativeai` module: configure(), list_models() and GenerativeModel."""
+
+    def __init__(self, latency_ms, jitter, error_rate, names_per_call, seed):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.names_per_call = names_per_call
+        self._rng = random.Random(seed)
+        self._names = itertools.count()
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def configure(self, **kwargs):
+        pass
+
+    def list_models(self):
+        return [types.SimpleNamespace(name='models/gemini-pro')]
+
+    def GenerativeModel(self, model_name, **kwargs):
+        return StubModel(self)
+
+    def _sample(self):
+        """Returns (latency seconds, fail?) for one call."""
+        with self._lock:
+            self.calls += 1
+            latency = self.latency_ms / 1000 * self._rng.lognormvariate(0, self.jitter) if self.jitter else self.latency_ms / 1000
+            return latency, self._rng.random() < self.error_rate
+
+    def _output(self, prompt):
+        match = re.search(r'Generate (\d+)', prompt)
+        count = self.names_per_call or (int(match.group(1)) if match else 1)
+        with self._lock:
+            return [f'StubName{next(self._names)}' for _ in range(count)]
+
+
+class StubModel:
+    def __init__(self, stub):
+        self._stub = stub
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        latency, fail = self._stub._sample()
+        names = self._stub._output(contents)
+        if not stream:
+            time.sleep(latency)
+            if fail:
+                raise RuntimeError("stub upstream error")
+            return StubResponse('\n'.join(names))
+
+        def chunks():
+            for name in names:
+                time.sleep(latency / len(names))
+                if fail:
+                    raise RuntimeError("stub upstream error")
+                yield StubResponse(name + '\n')
+        return chunks()
+
+
+def measure_cold_start(runs):
+    """Median wall time of `import main` in fresh interpreters, with the real dependencies."""
+    env = dict(os.environ, GEMINI_API_KEY='benchmark', LOG_LEVEL='OFF')
+    code = 'import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)'
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', code], cwd=FUNCTIONS_DIR, env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            return {'error': result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed'}
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return {'runs': runs, 'median_ms': round(statistics.median(samples) * 1000, 2), 'max_ms': round(max(samples) * 1000, 2)}
+
+
+def load_function(args):
+    """Imports main.py with logging off, swaps in the Gemini stub and lifts the rate limit."""
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+    os.environ['LOG_LEVEL'] = args.log_level
+    import main
+    from coordination import TokenBucketLimiter
+    stub = StubGemini(args.latency_ms, args.jitter, args.error_rate, args.names_per_call, args.seed)
+    main.genai = stub
+    if not args.keep_rate_limit:
+        main.rate_limiter = TokenBucketLimiter(10 ** 9, 10 ** 9)
+    return main, stub
+
+
+def build_app(main):
+    from flask import Flask, request
+    app = Flask('bench_generate_username')
+    app.add_url_rule('/', 'generate_username', lambda: main.generate_username(request), methods=['GET', 'POST', 'OPTIONS'])
+    return app
+
+
+def request_body(args, i):
+    body = {'prompt': f'benchmark prompt {i % args.prompts}', 'engine': args.engine}
+    if args.count:
+        body['count'] = args.count
+    if args.stream:
+        body['stream'] = True
+    return body
+
+
+class TestClientDriver:
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+    def post(self, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        response = client.post('/', json=body, headers={'X-Forwarded-For': '10.0.0.1'})
+        response.get_data() # Drains streaming responses
+        return response.status_code, int(response.headers.get('X-Upstream-Calls', 0))
+
+    def close(self):
+        pass
+
+
+class HttpDriver:
+    """Serves the app with werkzeug on a free local port and posts over real sockets."""
+
+    def __init__(self, app):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self._server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+        self._port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._local = threading.local()
+
+    def post(self, body):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection('127.0.0.1', self._port)
+        connection.request('POST', '/', body=json.dumps(body), headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        return response.status, int(response.getheader('X-Upstream-Calls') or 0)
+
+    def close(self):
+        self._server.shutdown()
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run_level(driver, args, concurrency, offset):
+    latencies = []
+    statuses = {}
+    upstream_calls = 0
+    lock = threading.Lock()
+    counter = itertools.count(offset)
+
+    def worker(requests):
+        nonlocal upstream_calls
+        for _ in range(requests):
+            i = next(counter)
+            started = time.perf_counter()
+            status, calls = driver.post(request_body(args, i))
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+                upstream_calls += calls
+
+    # Every level sends exactly --requests; the remainder goes to the first workers
+    share, extra = divmod(args.requests, concurrency)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, share + (1 if n < extra else 0)) for n in range(concurrency)]:
+            future.result()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    if not latencies:
+        return {'concurrency': concurrency, 'requests': 0}
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / wall, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2),
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'upstream_calls_reported': upstream_calls,
+    }
+
+
+def measure_allocations(driver, args, samples):
+    """Peak and retained bytes traced per request, measured sequentially (tracemalloc slows everything down)."""
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    try:
+        for i in range(samples):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            driver.post(request_body(args, i))
+            after, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(after - before)
+    finally:
+        tracemalloc.stop()
+    return {'samples': samples, 'mean_peak_bytes': round(statistics.mean(peaks)), 'mean_retained_bytes': round(statistics.mean(retained))}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=FUNCTIONS_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=1000, help="requests per concurrency level")
+    parser.add_argument('--latency-ms', type=float, default=300, help="median stub model latency")
+    parser.add_argument('--jitter', type=float, default=0.5, help="lognormal sigma of the stub latency (0 for fixed)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of stub model calls that raise")
+    parser.add_argument('--names-per-call', type=int, default=0, help="names returned per stub call (default: as many as the prompt asks for)")
+    parser.add_argument('--prompts', type=int, default=50, help="distinct prompts in the request mix (fewer means more cache hits)")
+    parser.add_argument('--engine', default='gemini', choices=['gemini', 'local', 'auto'])
+    parser.add_argument('--count', type=int, default=0, help="usernames per request (0 sends no 'count')")
+    parser.add_argument('--stream', action='store_true', help="use the streaming response mode")
+    parser.add_argument('--http', action='store_true', help="go through a local HTTP server instead of the Flask test client")
+    parser.add_argument('--reset-cache', action='store_true', help="start every concurrency level with an empty prompt cache")
+    parser.add_argument('--keep-rate-limit', action='store_true', help="leave the per-client rate limiter at its deployed settings")
+    parser.add_argument('--cold-start-runs', type=int, default=5)
+    parser.add_argument('--allocation-samples', type=int, default=200)
+    parser.add_argument('--log-level', default='OFF')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_generate_username.json')
+    args = parser.parse_args()
+    if args.requests < 1 or min(args.concurrency) < 1:
+        parser.error("--requests and --concurrency must be at least 1")
+    if args.requests < max(args.concurrency):
+        parser.error(f"--requests ({args.requests}) must be at least the highest --concurrency ({max(args.concurrency)})")
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'cold_start': measure_cold_start(args.cold_start_runs) if args.cold_start_runs else None,
+    }
+
+    main_module, stub = load_function(args)
+    driver = (HttpDriver if args.http else TestClientDriver)(build_app(main_module))
+    try:
+        results['allocations'] = measure_allocations(driver, args, args.allocation_samples) if args.allocation_samples else None
+        results['levels'] = []
+        offset = args.allocation_samples
+        for concurrency in args.concurrency:
+            if args.reset_cache:
+                cache = main_module.username_cache
+                main_module.username_cache = main_module.UsernamePoolCache(cache.max_keys, cache.ttl_seconds, backend=cache.backend,
+                                                                          refill_size=cache.refill_size, low_watermark=cache.low_watermark,
+                                                                          log_error=cache.log_error)
+            calls_before = stub.calls
+            level = run_level(driver, args, concurrency, offset)
+            level['stub_model_calls'] = stub.calls - calls_before
+            offset += level['requests']
+            results['levels'].append(level)
+            print(json.dumps(level))
+    finally:
+        driver.close()
+    results['function_stats'] = main_module.get_stats()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
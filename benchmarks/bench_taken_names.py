@@ -0,0 +1,72 @@
+"""Benchmark for the taken-names Bloom filter (functions/taken_names.py).
+
+Builds a filter from synthetic names, saves it, memory-maps it back the way
+the function does at cold start, and reports lookups per second, memory per
+million names and the measured false positive rate.
+
+    python benchmarks/bench_taken_names.py --names 1000000 --fp-rate 0.001 --output bench_taken_names.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions'))
+
+from taken_names import BloomFilter  # noqa: E402
+
+
+def run(names, fp_rate, lookups):
+    taken = [f'user{i:08d}' for i in range(names)]
+    results = {'names': names, 'fp_rate_target': fp_rate}
+
+    started = time.perf_counter()
+    bloom = BloomFilter.for_capacity(names, fp_rate)
+    bloom.update(taken)
+    results['build_seconds'] = round(time.perf_counter() - started, 3)
+    results['bytes_per_million_names'] = round(bloom.size_bytes / names * 1_000_000)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'taken.bloom')
+        bloom.save(path)
+        results['file_bytes'] = os.path.getsize(path)
+
+        started = time.perf_counter()
+        mapped = BloomFilter.load(path)
+        results['load_ms'] = round((time.perf_counter() - started) * 1000, 3)
+
+        hits = taken[:lookups]
+        started = time.perf_counter()
+        found = sum(1 for name in hits if name in mapped)
+        results['hit_lookups_per_second'] = round(len(hits) / (time.perf_counter() - started))
+        assert found == len(hits), "Bloom filters must not have false negatives"
+
+        misses = [f'free{i:08d}' for i in range(lookups)]
+        started = time.perf_counter()
+        false_positives = sum(1 for name in misses if name in mapped)
+        results['miss_lookups_per_second'] = round(len(misses) / (time.perf_counter() - started))
+        results['measured_fp_rate'] = round(false_positives / len(misses), 6)
+        results['expected_fp_rate'] = round(mapped.expected_fp_rate(), 6)
+        del hits, mapped
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--names', type=int, default=1_000_000)
+    parser.add_argument('--fp-rate', type=float, default=0.001)
+    parser.add_argument('--lookups', type=int, default=200_000)
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run(args.names, args.fp_rate, min(args.lookups, args.names))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Per-client rate limiting and single-flight request coalescing.
+
+Both work in-process by default. Given a shared store (FirestoreCoordinationStore),
+token buckets are shared by every function instance and single-flight extends
+across instances through short leases. InMemoryCoordinationStore implements the
+same interface and stands in for Firestore locally and in tests.
+
+A store implements:
+    consume_token(key, capacity, refill_per_second, now) -> seconds until a token is available (0 if one was taken)
+    acquire_lease(key, ttl_seconds, now) -> bool
+    release_lease(key)
+`now` is wall-clock time (time.time()) so it is comparable across instances.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from counters import Counters
+
+
+class InMemoryCoordinationStore:
+    """Coordination store for a single process. Bucket state is bounded with LRU eviction."""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict() # key -> [tokens, updated_at]
+        self._leases = {} # key -> expires_at
+
+    def consume_token(self, key, capacity, refill_per_second, now):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [capacity, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * refill_per_second)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / refill_per_second
+
+    def acquire_lease(self, key, ttl_seconds, now):
+        with self._lock:
+            if self._leases.get(key, 0) > now:
+                return False
+            self._leases[key] = now + ttl_seconds
+            return True
+
+    def release_lease(self, key):
+        with self._lock:
+            self._leases.pop(key, None)
+
+
+class FirestoreCoordinationStore:
+    """Token buckets and leases kept in Firestore, shared by every function instance.
+
+    Each consume_token() is one Firestore transaction, so this trades a round trip per
+    request for limits that hold across instances. Bucket documents carry an `expires_at`
+    timestamp, the moment the bucket is full again and so no different from a missing one;
+    a Firestore TTL policy on that field of the `<prefix>_buckets` collection deletes idle buckets.
+    """
+
+    def __init__(self, collection_prefix='coordination', client=None):
+        from firebase_admin import firestore
+        self._firestore = firestore
+        self._client = client or firestore.client()
+        self._buckets = self._client.collection(f'{collection_prefix}_buckets')
+        self._leases = self._client.collection(f'{collection_prefix}_leases')
+
+    @staticmethod
+    def _document_id(key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def consume_token(self, key, capacity, refill_per_second, now):
+        doc_ref = self._buckets.document(self._document_id(key))
+
+        @self._firestore.transactional
+        def consume_in_transaction(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            data = snapshot.to_dict() if snapshot.exists else None
+            tokens = capacity if not data else min(capacity, data['tokens'] + (now - data['updated_at']) * refill_per_second)
+            wait_seconds = 0.0 if tokens >= 1 else (1 - tokens) / refill_per_second
+            if tokens >= 1:
+                tokens -= 1
+            transaction.set(doc_ref, {
+                'tokens': tokens,
+                'updated_at': now,
+                'expires_at': datetime.fromtimestamp(now + (capacity - tokens) / refill_per_second, tz=timezone.utc),
+            })
+            return wait_seconds
+
+        return consume_in_transaction(self._client.transaction())
+
+    def acquire_lease(self, key, ttl_seconds, now):
+        doc_ref = self._leases.document(self._document_id(key))
+
+        @self._firestore.transactional
+        def acquire_in_transaction(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            if snapshot.exists and snapshot.to_dict().get('expires_at', 0) > now:
+                return False
+            transaction.set(doc_ref, {'expires_at': now + ttl_seconds})
+            return True
+
+        return acquire_in_transaction(self._client.transaction())
+
+    def release_lease(self, key):
+        self._leases.document(self._document_id(key)).delete()
+
+
+class TokenBucketLimiter:
+    """Allows `capacity` requests in a burst per client, refilled at `refill_per_second`."""
+
+    def __init__(self, capacity, refill_per_second, store=None):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.store = store or InMemoryCoordinationStore()
+        self.stats = Counters('allowed', 'limited', 'store_errors')
+
+    def check(self, client_key):
+        """Returns 0 if the request may proceed, otherwise the number of seconds the client should wait.
+
+        Store failures let the request through; the limiter protects quota, it must not take the function down.
+        """
+        try:
+            wait_seconds = self.store.consume_token(client_key, self.capacity, self.refill_per_second, time.time())
+        except Exception:
+            self.stats.incr('store_errors')
+            return 0.0
+        self.stats.incr('limited' if wait_seconds else 'allowed')
+        return wait_seconds
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time. Concurrent callers for the same key wait and share its result.
+
+    With a shared `store`, a lease extends this across instances: while another instance holds
+    the lease, the caller polls `ready()` (e.g. "the shared pool has enough names") instead of
+    repeating the work, and only runs it itself if the lease expires first.
+    """
+
+    def __init__(self, store=None, lease_seconds=15.0, poll_seconds=0.1):
+        self.store = store
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.stats = Counters('leaders', 'coalesced', 'remote_coalesced', 'wait_timeouts', 'store_errors')
+
+    def do(self, key, fn, ready=None, timeout=None):
+        """Returns (result, ran). `ran` is False when the result came from another caller's call of `fn`
+        (or, across instances, when `ready()` became true and the result is None).
+
+        Waiting for another caller gives up after `timeout` seconds and returns (None, False);
+        `fn` itself is never interrupted.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.stats.incr('coalesced')
+            if not flight.done.wait(timeout):
+                self.stats.incr('wait_timeouts')
+                return None, False
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, False
+
+        try:
+            flight.result, ran = self._lead(key, fn, ready, timeout)
+            return flight.result, ran
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _lead(self, key, fn, ready, timeout):
+        if self.store is None or ready is None:
+            self.stats.incr('leaders')
+            return fn(), True
+        acquired = False
+        try:
+            started = time.monotonic()
+            deadline = started + self.lease_seconds
+            while not acquired:
+                acquired = self.store.acquire_lease(key, self.lease_seconds, time.time())
+                if not acquired:
+                    time.sleep(self.poll_seconds)
+                    # Checked before retrying the lease, which the other instance releases once its result is stored
+                    if ready():
+                        self.stats.incr('remote_coalesced')
+                        return None, False
+                    if timeout is not None and time.monotonic() - started >= timeout:
+                        self.stats.incr('wait_timeouts')
+                        return None, False
+                    if time.monotonic() >= deadline:
+                        break # The other instance is presumably gone; do the work without a lease
+        except Exception:
+            self.stats.incr('store_errors')
+
+        self.stats.incr('leaders')
+        try:
+            return fn(), True
+        finally:
+            if acquired:
+                try:
+                    self.store.release_lease(key)
+                except Exception:
+                    self.stats.incr('store_errors')
@@ -0,0 +1,30 @@
+"""Thread-safe counters for the per-instance stats the function reports.
+
+Request threads, model-call workers and background refills all bump the same
+counters, and `d[key] += 1` on a plain dict can lose increments when two
+threads interleave, so every increment takes a lock.
+"""
+import threading
+
+
+class Counters:
+    """A fixed set of named integer counters."""
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(names, 0)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def __getitem__(self, name):
+        return self._counts[name]
+
+    def snapshot(self):
+        """A consistent copy of every counter."""
+        with self._lock:
+            return dict(self._counts)
+
+    def __repr__(self):
+        return f'Counters({self.snapshot()})'
@@ -0,0 +1,154 @@
+"""Offline username generator used as a fallback (and fast path) for Gemini.
+
+Names are built from prompt keywords, themed word lists, affixes, leetspeak and
+number suffixes. Everything that does not depend on the random draw is
+precomputed: the theme index at import time, and the word lists (with their
+leetspeak variants) for a prompt the first time that prompt is seen. Each name
+costs one random() call, decoded into a word list, head, tail, prefix and
+suffix; the head x tail combinations are never materialized.
+"""
+import random
+import re
+from functools import lru_cache
+
+ADJECTIVES = (
+    'Agile', 'Ancient', 'Arcane', 'Atomic', 'Bold', 'Brave', 'Bright', 'Chill', 'Clever', 'Cosmic',
+    'Crimson', 'Crystal', 'Cyber', 'Dark', 'Digital', 'Electric', 'Epic', 'Feral', 'Fierce', 'Frozen',
+    'Funky', 'Fuzzy', 'Ghost', 'Golden', 'Hyper', 'Icy', 'Iron', 'Jolly', 'Lucky', 'Lunar',
+    'Mega', 'Mighty', 'Mystic', 'Neon', 'Nimble', 'Noble', 'Omega', 'Pixel', 'Quantum', 'Quick',
+    'Rapid', 'Rogue', 'Royal', 'Rusty', 'Savage', 'Shadow', 'Silent', 'Silver', 'Sly', 'Solar',
+    'Sonic', 'Stealth', 'Storm', 'Swift', 'Turbo', 'Ultra', 'Velvet', 'Wild', 'Wicked', 'Zen',
+)
+
+NOUNS = (
+    'Badger', 'Bandit', 'Bear', 'Blade', 'Blaze', 'Bolt', 'Byte', 'Comet', 'Coyote', 'Dragon',
+    'Drift', 'Eagle', 'Echo', 'Falcon', 'Fang', 'Flame', 'Fox', 'Frost', 'Gecko', 'Ghost',
+    'Glitch', 'Golem', 'Hawk', 'Hunter', 'Jaguar', 'Jester', 'Knight', 'Lynx', 'Mantis', 'Nova',
+    'Ninja', 'Onyx', 'Orbit', 'Otter', 'Owl', 'Panda', 'Panther', 'Phoenix', 'Pilot', 'Pirate',
+    'Quest', 'Raven', 'Rebel', 'Ronin', 'Sage', 'Shark', 'Sparrow', 'Specter', 'Sphinx', 'Spark',
+    'Tiger', 'Titan', 'Viper', 'Vortex', 'Walker', 'Wizard', 'Wolf', 'Wraith', 'Yeti', 'Zephyr',
+)
+
+# Theme -> (trigger keywords, related words). Triggers also match on a 4 letter prefix ("gaming" -> "gami").
+THEMES = {
+    'gaming': (('gamer', 'gaming', 'game', 'games', 'esports', 'fps', 'rpg', 'player'),
+               ('Gamer', 'Frag', 'Respawn', 'Loot', 'Combo', 'Boss', 'Quest', 'Noob', 'Clutch', 'Sniper')),
+    'tech': (('tech', 'coder', 'code', 'coding', 'dev', 'developer', 'hacker', 'computer', 'programmer'),
+             ('Code', 'Byte', 'Bit', 'Kernel', 'Stack', 'Hex', 'Script', 'Packet', 'Logic', 'Circuit')),
+    'future': (('futuristic', 'future', 'scifi', 'sci-fi', 'space', 'robot', 'cyber'),
+               ('Nova', 'Astro', 'Quantum', 'Nebula', 'Orbit', 'Droid', 'Plasma', 'Laser', 'Nexus', 'Warp')),
+    'nature': (('nature', 'forest', 'outdoors', 'hiking', 'tree', 'plant', 'green'),
+               ('Fern', 'Moss', 'Cedar', 'Willow', 'Grove', 'Trail', 'Bloom', 'Pine', 'River', 'Canyon')),
+    'ocean': (('ocean', 'sea', 'beach', 'surf', 'surfer', 'water', 'wave', 'sailor'),
+              ('Wave', 'Tide', 'Reef', 'Coral', 'Shark', 'Surf', 'Kraken', 'Harbor', 'Drift', 'Marlin')),
+    'music': (('music', 'musician', 'dj', 'singer', 'guitar', 'band', 'beats', 'rock'),
+              ('Beat', 'Riff', 'Chord', 'Tempo', 'Vinyl', 'Bass', 'Echo', 'Melody', 'Rhythm', 'Groove')),
+    'fantasy': (('fantasy', 'magic', 'wizard', 'dragon', 'medieval', 'elf', 'knight', 'myth'),
+                ('Rune', 'Spell', 'Dragon', 'Knight', 'Elf', 'Wyrm', 'Mage', 'Grimoire', 'Oracle', 'Paladin')),
+    'sports': (('sports', 'sport', 'athlete', 'football', 'soccer', 'basketball', 'runner', 'fitness'),
+               ('Striker', 'Goal', 'Dunk', 'Sprint', 'Champ', 'Ace', 'Captain', 'Pitch', 'Rally', 'Racer')),
+    'cute': (('cute', 'kawaii', 'sweet', 'soft', 'cozy', 'pastel', 'bunny', 'cat'),
+             ('Bunny', 'Kitten', 'Mochi', 'Cupcake', 'Bubbles', 'Muffin', 'Sprinkle', 'Panda', 'Peach', 'Boba')),
+    'dark': (('dark', 'goth', 'gothic', 'horror', 'spooky', 'night', 'shadow', 'edgy'),
+             ('Shade', 'Raven', 'Grim', 'Crypt', 'Phantom', 'Nightfall', 'Reaper', 'Void', 'Eclipse', 'Hex')),
+}
+
+PREFIXES = ('', '', '', '', '', '', 'x', 'The', 'Its', 'Mr', 'Real', 'Not', 'Just')
+SUFFIXES = (
+    '', '', '', '', '', '', '', '', 'X', 'HQ', 'TV', 'GG', 'Pro', 'YT', 'Live', 'Official',
+) + tuple(str(n) for n in (1, 7, 9, 11, 13, 21, 23, 42, 64, 69, 77, 88, 99, 101, 123, 404, 777, 999, 1337, 2000)) \
+  + tuple(f'_{n}' for n in (1, 7, 42, 99))
+
+LEET = str.maketrans({'a': '4', 'A': '4', 'e': '3', 'E': '3', 'i': '1', 'I': '1', 'o': '0', 'O': '0', 's': '5', 'S': '5', 't': '7', 'T': '7'})
+
+MAX_USERNAME_LENGTH = 30
+MAX_KEYWORD_LENGTH = 12
+MAX_KEYWORDS = 6 # Keywords per prompt that shape the word lists; the rest of a long prompt is ignored
+MAX_BASE_LENGTH = MAX_USERNAME_LENGTH - 8 # Leaves room for a prefix and suffix
+LEET_SHARE = 0.2 # Fraction of names written in leetspeak
+MAX_ROUNDS = 8 # Draw rounds per generate() call before giving up on reaching `count` unique names
+
+_THEME_INDEX = {}
+for _triggers, _words in THEMES.values():
+    for _trigger in _triggers:
+        _THEME_INDEX.setdefault(_trigger, []).extend(_words)
+        _THEME_INDEX.setdefault(_trigger[:4], []).extend(_words)
+_THEME_INDEX = {key: tuple(dict.fromkeys(words)) for key, words in _THEME_INDEX.items()}
+
+
+def prompt_keywords(prompt):
+    """Up to MAX_KEYWORDS alphanumeric keywords from a prompt, lowercased and sorted so keyword order does not matter."""
+    words = dict.fromkeys(word[:MAX_KEYWORD_LENGTH] for word in re.findall(r'[a-z0-9]+', prompt.lower()) if len(word) > 1)
+    return tuple(sorted(list(words)[:MAX_KEYWORDS]))
+
+
+# Entries are a few short tuples of words and their leetspeak variants (about 6 KB for a
+# six-keyword prompt), so a full cache stays under two megabytes.
+@lru_cache(maxsize=256)
+def candidate_parts(keywords):
+    """Word lists for a keyword tuple as (end, start, scale, heads, tails) regions of [0, 1).
+
+    A random x in [start, end) picks the region, and int((x - start) * scale) numbers one
+    head x tail x prefix x suffix combination in it. Regions are sized by their number of
+    head x tail combinations; each has a leetspeak twin that gets LEET_SHARE of its share.
+    """
+    themed = []
+    for keyword in keywords:
+        themed.extend(_THEME_INDEX.get(keyword) or _THEME_INDEX.get(keyword[:4], ()))
+    own = tuple(keyword.capitalize() for keyword in keywords)
+    heads = tuple(dict.fromkeys(own + tuple(themed))) or ADJECTIVES
+    tails = tuple(dict.fromkeys(tuple(themed) + NOUNS))
+    weighted = []
+    for first, second in ((heads, tails), (ADJECTIVES, own)) if own else ((heads, tails),):
+        weight = len(first) * len(second)
+        weighted.append((weight * (1 - LEET_SHARE), first, second))
+        weighted.append((weight * LEET_SHARE, tuple(w.translate(LEET) for w in first), tuple(w.translate(LEET) for w in second)))
+    total = sum(weight for weight, _, _ in weighted)
+    regions = []
+    start = 0.0
+    for weight, first, second in weighted:
+        end = start + weight / total
+        regions.append((end, start, len(first) * len(second) * len(PREFIXES) * len(SUFFIXES) / (end - start), first, second))
+        start = end
+    regions[-1] = (1.0,) + regions[-1][1:] # random() < 1.0, so rounding can never fall past the last region
+    return tuple(regions)
+
+
+class LocalUsernameEngine:
+    """Generates usernames without any network access. Output is deterministic for a given seed."""
+
+    def __init__(self, seed=None):
+        self._rng = random.Random(seed)
+
+    def generate(self, prompt, count, seed=None):
+        """Returns up to `count` unique usernames for `prompt`. A `seed` makes this call reproducible."""
+        keywords = prompt_keywords(prompt)
+        rng = self._rng if seed is None else random.Random(f'{seed}:{keywords}')
+        regions = candidate_parts(keywords)
+        random_ = rng.random
+        num_prefixes = len(PREFIXES)
+        num_suffixes = len(SUFFIXES)
+        usernames = {}
+        for _ in range(MAX_ROUNDS):
+            missing = count - len(usernames)
+            if missing <= 0:
+                break
+            for _ in range(missing + missing // 4 + 4):
+                x = random_()
+                for end, start, scale, heads, tails in regions:
+                    if x < end:
+                        break
+                combination, head = divmod(int((x - start) * scale), len(heads))
+                combination, tail = divmod(combination, len(tails))
+                combination, prefix = divmod(combination, num_prefixes)
+                head = heads[head]
+                tail = tails[tail]
+                if head == tail:
+                    continue
+                base = head + tail
+                if len(base) > MAX_BASE_LENGTH:
+                    continue
+                name = PREFIXES[prefix] + base + SUFFIXES[combination % num_suffixes]
+                if len(name) <= MAX_USERNAME_LENGTH:
+                    usernames.setdefault(name.lower(), name)
+        return list(usernames.values())[:count]
@@ -1,120 +1,922 @@
+import hashlib
+import hmac
+import json
+import math
 import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from functools import partial
 import google.generativeai as genai
+from flask import Response
 from firebase_functions.https_fn import on_request
 from firebase_admin import initialize_app
+from coordination import FirestoreCoordinationStore, SingleFlight, TokenBucketLimiter
+from counters import Counters
+from local_engine import LocalUsernameEngine
+from taken_names import BloomFilter
+from username_cache import FirestorePoolBackend, UsernamePoolCache, normalize_prompt
 
 # Constants
 GEMINI_API_KEY_ENV_NAME = "GEMINI_API_KEY" # Use this constant for the environment variable name
 GEMINI_MODEL_NAME = 'models/gemini-pro'
+MODEL_AVAILABILITY_TTL_SECONDS = 600 # How long a list_models() result is trusted before a background refresh
+STATS_TOKEN_ENV_NAME = "STATS_TOKEN" # Bearer token that unlocks per-instance stats on GET; unset disables the endpoint
+MAX_BATCH_COUNT = 50 # Upper bound for the optional 'count' field in POST requests
+BATCH_OVERSAMPLE = 1.3 # Ask for a few extra candidates so that dedupe/validation rarely needs a top-up call
+MAX_BATCH_TOP_UP_CALLS = 2 # Extra model calls allowed when a batch comes back short
+MAX_PARALLEL_BATCHES = 4 # Batch calls a coalesced miss may run at once to serve a burst of waiting requests
+USERNAME_CACHE_MAX_KEYS = 2048 # Normalized prompts kept in memory per instance (LRU beyond that)
+USERNAME_CACHE_TTL_SECONDS = 3600 # Pools older than this are discarded
+USERNAME_CACHE_REFILL_SIZE = 20 # Extra usernames generated per model call to stock the pool
+USERNAME_CACHE_LOW_WATERMARK = 5 # A pool below this size is topped up in the background
+USERNAME_CACHE_BACKEND_ENV_NAME = "USERNAME_CACHE_BACKEND" # Set to 'firestore' to share pools between instances
+USERNAME_CACHE_FIRESTORE_COLLECTION = 'username_pools'
+RATE_LIMIT_BURST = 30 # Requests a client may make back to back
+RATE_LIMIT_REFILL_PER_SECOND = 0.5 # Sustained requests per second per client
+CLIENT_API_KEY_HEADER = 'X-API-Key' # Clients sending a known key are limited per key instead of per IP
+CLIENT_API_KEYS_ENV_NAME = "CLIENT_API_KEY_SHA256S" # Comma-separated SHA-256 hex digests of the accepted client API keys
+COORDINATION_BACKEND_ENV_NAME = "COORDINATION_BACKEND" # Set to 'firestore' to share rate limits and coalescing between instances (needs the Firestore pool backend)
+ENGINE_GEMINI = 'gemini'
+ENGINE_LOCAL = 'local'
+ENGINE_AUTO = 'auto'
+ENGINES = (ENGINE_GEMINI, ENGINE_LOCAL, ENGINE_AUTO)
+DEFAULT_ENGINE_ENV_NAME = "USERNAME_ENGINE" # Engine used when a request does not pick one (defaults to 'gemini')
+AUTO_ENGINE_LATENCY_BUDGET_SECONDS = 2.5 # In 'auto' mode, fall back to the local engine after this long
+GEMINI_WORKER_THREADS = 16
+GEMINI_DEADLINE_ENV_NAME = "GEMINI_DEADLINE_SECONDS" # Overrides the per-call deadline below
+GEMINI_DEADLINE_SECONDS = float(os.environ.get(GEMINI_DEADLINE_ENV_NAME, 10)) # Hard limit for one model call, hedge included
+GEMINI_MAX_IN_FLIGHT = 32 # Concurrent generate_content calls per instance (hedges included)
+HEDGE_PERCENTILE = 0.95 # A hedge request fires once the first call has been running this latency percentile
+HEDGE_MIN_DELAY_SECONDS = 0.5 # Floor for the hedge delay, so a fast p95 does not double every call
+HEDGE_DEFAULT_DELAY_SECONDS = 3.0 # Hedge delay used until enough latencies have been recorded
+LATENCY_WINDOW = 200 # Recent model call latencies kept for the percentile estimate
+FUNCTION_CONCURRENCY = 80 # Requests one Cloud Run container serves at once
+TAKEN_NAMES_FILTER_ENV_NAME = "TAKEN_NAMES_FILTER_PATH" # Bloom filter file built with taken_names.py; unset disables the check
+USERNAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{1,29}$')
+
+LOG_LEVEL_ENV_NAME = "LOG_LEVEL" # DEBUG, INFO, WARNING, ERROR or OFF (defaults to INFO)
+LOG_SAMPLE_RATE_ENV_NAME = "LOG_SAMPLE_RATE" # Fraction of successful requests that get a request log line (defaults to 1)
 
 # Initialize Firebase Admin SDK if not already initialized
 initialize_app()
 
+
+# --- Structured logging ---
+# One JSON object per line on stdout, which Cloud Logging ingests as a structured entry.
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'OFF': 100}
+log_level = LOG_LEVELS.get(os.environ.get(LOG_LEVEL_ENV_NAME, 'INFO').upper(), LOG_LEVELS['INFO'])
+log_sample_rate = float(os.environ.get(LOG_SAMPLE_RATE_ENV_NAME, 1))
+
+
+def log(severity, message, **fields):
+    """Writes a structured log line. A disabled severity costs one dict lookup and a comparison."""
+    if LOG_LEVELS[severity] < log_level:
+        return
+    sys.stdout.write(json.dumps({'severity': severity, 'message': message, **fields}, default=str) + '\n')
+
+
+class RequestTrace:
+    """Per-request stage durations, written as a single log line when the request finishes."""
+
+    __slots__ = ('request_id', 'started', 'stages', 'fields')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = {}
+
+    def add(self, stage, since):
+        """Adds the time elapsed since `since` (a perf_counter() value) to `stage` and returns the current perf_counter()."""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - since
+        return now
+
+    def merge(self, other):
+        """Adds the stage durations of `other`, a trace nothing writes to any more."""
+        for stage, seconds in other.stages.items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def emit(self, status):
+        severity = 'ERROR' if status >= 500 else 'INFO'
+        if LOG_LEVELS[severity] < log_level or (severity == 'INFO' and log_sample_rate < 1 and random.random() >= log_sample_rate):
+            return
+        log(severity, 'request', request_id=self.request_id, status=status,
+            total_ms=round((time.perf_counter() - self.started) * 1000, 2),
+            stages_ms={stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()},
+            **self.fields)
+
+
+UNTRACED = RequestTrace(None) # Timing sink for work that does not belong to a request (background refills)
+
+
+class ModelAvailabilityCache:
+    """Caches whether GEMINI_MODEL_NAME shows up in genai.list_models().
+
+    Lookups never call the upstream API: a stale or missing entry schedules a
+    refresh on a background thread and the last known value is returned.
+    """
+
+    def __init__(self, model_name, ttl_seconds):
+        self.model_name = model_name
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._available = None # None until the first refresh completes
+        self._checked_at = 0.0
+        self._refreshing = False
+        self.stats = Counters('hits', 'misses', 'refreshes', 'refresh_errors', 'invalidations')
+
+    def get(self):
+        """Returns True/False from the last check, or None if no check has completed yet."""
+        start_refresh = False
+        with self._lock:
+            fresh = self._available is not None and time.monotonic() - self._checked_at < self.ttl_seconds
+            self.stats.incr('hits' if fresh else 'misses')
+            if not fresh and not self._refreshing:
+                self._refreshing = True
+                start_refresh = True
+            available = self._available
+        if start_refresh:
+            threading.Thread(target=self._refresh, name="model-availability-refresh", daemon=True).start()
+        return available
+
+    @property
+    def available(self):
+        """The last known result, without counting a lookup or scheduling a refresh."""
+        with self._lock:
+            return self._available
+
+    def invalidate(self):
+        with self._lock:
+            self._available = None
+            self._checked_at = 0.0
+            self.stats.incr('invalidations')
+
+    def _refresh(self):
+        try:
+            available_models = [m.name for m in genai.list_models()]
+            available = self.model_name in available_models
+            with self._lock:
+                self._available = available
+                self._checked_at = time.monotonic()
+                self.stats.incr('refreshes')
+            if not available:
+                log('WARNING', "Model is not in the list of available models. Please check exact model name and API permissions.",
+                    model=self.model_name, models_listed=len(available_models))
+        except Exception as e:
+            with self._lock:
+                self.stats.incr('refresh_errors')
+            log('ERROR', "Listing models failed", error=repr(e))
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+# --- Per-instance Gemini client ---
+# genai.configure() and the GenerativeModel are set up once per instance (on first use)
+# and reused across invocations. They are only rebuilt if the API key changes.
+_client_lock = threading.Lock()
+_configured_api_key = None
+_model = None
+model_availability = ModelAvailabilityCache(GEMINI_MODEL_NAME, MODEL_AVAILABILITY_TTL_SECONDS)
+
+
+def get_model(api_key):
+    global _configured_api_key, _model
+    if _model is not None and _configured_api_key == api_key:
+        return _model
+    with _client_lock:
+        if _model is None or _configured_api_key != api_key:
+            genai.configure(api_key=api_key)
+            _model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+            _configured_api_key = api_key
+            model_availability.invalidate()
+    return _model
+
+
+# --- Model calls: deadlines, hedging and bounded concurrency ---
+class LatencyTracker:
+    """Sliding window of recent latencies with a cached percentile estimate."""
+
+    def __init__(self, window, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._sorted = None
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._sorted = None
+
+    def percentile(self, q):
+        """Returns the q-th percentile (0-1), or None until min_samples have been recorded."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._samples)
+            return self._sorted[min(len(self._sorted) - 1, int(q * len(self._sorted)))]
+
+
+model_latency = LatencyTracker(LATENCY_WINDOW)
+_model_call_slots = threading.BoundedSemaphore(GEMINI_MAX_IN_FLIGHT)
+_model_call_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_IN_FLIGHT, thread_name_prefix="gemini-call")
+model_call_stats = Counters('calls', 'errors', 'hedges_fired', 'hedges_won', 'hedges_skipped', 'deadline_expirations', 'slot_timeouts')
+
+
+def hedge_delay():
+    p95 = model_latency.percentile(HEDGE_PERCENTILE)
+    return HEDGE_DEFAULT_DELAY_SECONDS if p95 is None else max(HEDGE_MIN_DELAY_SECONDS, p95)
+
+
+def _timed_generate(model, contents, timeout):
+    """Runs on a model-call worker. The caller has already acquired a slot; it is released here."""
+    started = time.monotonic()
+    try:
+        response = model.generate_content(contents, request_options={'timeout': timeout})
+        response.text # Raises for blocked/empty candidates, so the hedge can still win
+        model_latency.record(time.monotonic() - started)
+        return response
+    finally:
+        _model_call_slots.release()
+
+
+def call_model(model, contents, deadline=None):
+    """model.generate_content() with a deadline and a hedged second request.
+
+    If the first call is still running after the recent p95 latency, an identical call
+    is fired (only when an in-flight slot is free) and whichever succeeds first wins.
+    Returns (response, upstream_calls), where upstream_calls is 2 when the hedge fired.
+    Raises TimeoutError when the deadline passes, or the last upstream error; errors raised after
+    a call was made carry the number of calls as `upstream_calls`.
+    """
+    deadline = GEMINI_DEADLINE_SECONDS if deadline is None else deadline
+    started = time.monotonic()
+    deadline_at = started + deadline
+    if not _model_call_slots.acquire(timeout=deadline):
+        model_call_stats.incr('slot_timeouts')
+        raise TimeoutError(f"No Gemini call slot became free within {deadline}s")
+    model_call_stats.incr('calls')
+    primary = _model_call_executor.submit(_timed_generate, model, contents, deadline)
+    pending = {primary}
+    hedge_at = started + hedge_delay()
+    hedged = False
+    hedge_fired = False
+    error = None
+
+    while pending:
+        now = time.monotonic()
+        if now >= deadline_at:
+            break
+        done, pending = wait(pending, timeout=(deadline_at if hedged else min(hedge_at, deadline_at)) - now, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response = future.result()
+            except Exception as e:
+                model_call_stats.incr('errors')
+                error = e
+                continue
+            if future is not primary:
+                model_call_stats.incr('hedges_won')
+            return response, 2 if hedge_fired else 1
+        if pending and not hedged and time.monotonic() >= hedge_at:
+            hedged = True
+            if _model_call_slots.acquire(blocking=False):
+                model_call_stats.incr('hedges_fired')
+                hedge_fired = True
+                pending.add(_model_call_executor.submit(_timed_generate, model, contents, deadline_at - time.monotonic()))
+            else:
+                model_call_stats.incr('hedges_skipped')
+
+    if pending:
+        model_call_stats.incr('deadline_expirations')
+        error = TimeoutError(f"Gemini did not respond within {deadline}s")
+    error.upstream_calls = 2 if hedge_fired else 1
+    raise error
+
+
+# --- Taken-names filter ---
+def _load_taken_names():
+    path = os.environ.get(TAKEN_NAMES_FILTER_ENV_NAME)
+    if not path:
+        return None
+    try:
+        return BloomFilter.load(path) # Memory-mapped, so this is cheap even for tens of millions of names
+    except (OSError, ValueError) as e:
+        log('ERROR', "Loading taken-names filter failed; names will not be checked", path=path, error=repr(e))
+        return None
+
+
+# Anything supporting `name in taken_names` can be plugged in here (a set works for small lists).
+taken_names = _load_taken_names()
+taken_names_stats = Counters('checked', 'rejected')
+
+
+def is_available(username):
+    """False when the taken-names filter says the username is already claimed."""
+    if taken_names is None:
+        return True
+    taken_names_stats.incr('checked')
+    if username in taken_names:
+        taken_names_stats.incr('rejected')
+        return False
+    return True
+
+
+# --- Batch generation ---
+def build_batch_prompt(prompt, count, exclude=()):
+    batch_prompt = (
+        f"Generate {count} unique and creative usernames based on these keywords/themes: '{prompt}'. "
+        "Keep each one concise, single word if possible, and suitable for online use. "
+        "Return one username per line, no extra text, numbering, or explanations."
+    )
+    if exclude:
+        batch_prompt += f" Do not repeat any of these: {', '.join(exclude)}."
+    return batch_prompt
+
+
+def parse_usernames(text):
+    """Splits model output into candidate usernames, dropping list markers, quotes and invalid entries."""
+    usernames = []
+    for line in re.split(r'[\n,]', text or ''):
+        candidate = re.sub(r'^\s*(?:\d+[.)]|[-*\u2022])\s*', '', line).strip().strip('"\'`').strip()
+        if USERNAME_PATTERN.match(candidate):
+            usernames.append(candidate)
+    return usernames
+
+
+def generate_batch(model, prompt, count, minimum=None, deadline_at=None):
+    """Returns (usernames, upstream_calls) with up to `count` case-insensitively unique names.
+
+    Top-up calls are only made while fewer than `minimum` (default: `count`) names have been collected.
+    With a `deadline_at` (a time.monotonic() value) every call gets only the time that is left, and
+    no call is started once it has passed.
+    """
+    minimum = count if minimum is None else minimum
+    usernames = []
+    seen = set()
+    upstream_calls = 0
+    attempts = 0 # Unlike upstream_calls, hedges do not count here
+    while len(usernames) < minimum and attempts <= MAX_BATCH_TOP_UP_CALLS:
+        deadline = GEMINI_DEADLINE_SECONDS
+        if deadline_at is not None:
+            deadline = min(deadline, deadline_at - time.monotonic())
+            if deadline <= 0:
+                break
+        missing = count - len(usernames)
+        requested = min(MAX_BATCH_COUNT, max(missing, int(missing * BATCH_OVERSAMPLE + 0.5)))
+        attempts += 1
+        try:
+            response, calls = call_model(model, build_batch_prompt(prompt, requested, exclude=usernames), deadline=deadline)
+        except Exception as e:
+            if not usernames:
+                raise
+            # A failed top-up does not throw away the names already collected
+            log('WARNING', "Batch top-up call failed", error=repr(e))
+            upstream_calls += getattr(e, 'upstream_calls', 0)
+            break
+        upstream_calls += calls
+        for username in parse_usernames(response.text):
+            if username.lower() not in seen and is_available(username):
+                seen.add(username.lower())
+                usernames.append(username)
+    return usernames[:count], upstream_calls
+
+
+# --- Prompt-keyed username cache ---
+def _create_username_cache_backend():
+    if os.environ.get(USERNAME_CACHE_BACKEND_ENV_NAME, '').lower() == 'firestore':
+        return FirestorePoolBackend(USERNAME_CACHE_FIRESTORE_COLLECTION)
+    return None
+
+
+username_cache = UsernamePoolCache(USERNAME_CACHE_MAX_KEYS, USERNAME_CACHE_TTL_SECONDS, backend=_create_username_cache_backend(),
+                                   refill_size=USERNAME_CACHE_REFILL_SIZE, low_watermark=USERNAME_CACHE_LOW_WATERMARK,
+                                   log_error=partial(log, 'ERROR'))
+
+
+# --- Rate limiting and request coalescing ---
+def _create_coordination_store():
+    if os.environ.get(COORDINATION_BACKEND_ENV_NAME, '').lower() == 'firestore':
+        # Instances waiting on another instance's lease poll the shared pool for its result; with
+        # per-instance pools they would never see it and redo the call once the lease expires.
+        if os.environ.get(USERNAME_CACHE_BACKEND_ENV_NAME, '').lower() != 'firestore':
+            raise ValueError(f"{COORDINATION_BACKEND_ENV_NAME}=firestore requires {USERNAME_CACHE_BACKEND_ENV_NAME}=firestore")
+        return FirestoreCoordinationStore()
+    return None # In-process only
+
+
+_coordination_store = _create_coordination_store()
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_BURST, RATE_LIMIT_REFILL_PER_SECOND, store=_coordination_store)
+model_flights = SingleFlight(store=_coordination_store) # Concurrent misses for one prompt key share a model call
+
+
+client_api_key_digests = frozenset(d.strip().lower() for d in os.environ.get(CLIENT_API_KEYS_ENV_NAME, '').split(',') if d.strip())
+
+
+def client_key(request):
+    """Rate limit identity: a known API key if the client sends one, otherwise the caller's IP.
+
+    Unknown keys are ignored, so inventing keys does not buy fresh buckets. The IP is the last
+    X-Forwarded-For entry, the one appended by Google's front end; earlier entries are client-supplied.
+    """
+    api_key = request.headers.get(CLIENT_API_KEY_HEADER)
+    if api_key and client_api_key_digests:
+        digest = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        if digest in client_api_key_digests:
+            return 'key:' + digest
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    return 'ip:' + (forwarded_for.rsplit(',', 1)[-1].strip() if forwarded_for else request.remote_addr or 'unknown')
+
+
+_pending_demand_lock = threading.Lock()
+_pending_demand = {} # prompt key -> usernames still owed to requests waiting in serve_usernames()
+_batch_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_IN_FLIGHT, thread_name_prefix="gemini-batch")
+
+
+def _add_demand(key, usernames):
+    with _pending_demand_lock:
+        pending = _pending_demand.get(key, 0) + usernames
+        if pending > 0:
+            _pending_demand[key] = pending
+        else:
+            _pending_demand.pop(key, None)
+
+
+def generate_for_demand(model, prompt, demand, deadline_at=None):
+    """Returns (usernames, upstream_calls) for `demand` names plus a pool refill.
+
+    Demand beyond one batch is split into up to MAX_PARALLEL_BATCHES concurrent batches.
+    Raises only if every batch failed.
+    """
+    total = demand + USERNAME_CACHE_REFILL_SIZE
+    sizes = [MAX_BATCH_COUNT] * min(MAX_PARALLEL_BATCHES - 1, (total - 1) // MAX_BATCH_COUNT)
+    sizes.append(min(MAX_BATCH_COUNT, total - sum(sizes)))
+    minimums = []
+    for size in sizes:
+        minimums.append(max(1, min(size, demand)))
+        demand -= size
+    if len(sizes) == 1:
+        return generate_batch(model, prompt, sizes[0], minimum=minimums[0], deadline_at=deadline_at)
+
+    futures = [_batch_executor.submit(generate_batch, model, prompt, size, minimum, deadline_at) for size, minimum in zip(sizes, minimums)]
+    usernames = []
+    upstream_calls = 0
+    error = None
+    for future in futures:
+        try:
+            generated, calls = future.result()
+        except Exception as e:
+            error = e
+            continue
+        usernames += generated
+        upstream_calls += calls
+    if error is not None and not usernames:
+        raise error
+    return usernames, upstream_calls
+
+
+class UsernameCollector:
+    """Names taken from the prompt cache on behalf of one request.
+
+    A caller that stops waiting calls abandon(): it keeps what was collected so far and
+    later take() calls hand out nothing, so a run that outlives its request only stocks the cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.usernames = []
+        self.abandoned = False
+
+    def take(self, key, count):
+        """Takes up to `count` names for `key` into self.usernames; returns how many were taken."""
+        with self._lock:
+            if self.abandoned:
+                return 0
+            taken = username_cache.take(key, count)
+            self.usernames.extend(taken)
+            return len(taken)
+
+    def abandon(self):
+        with self._lock:
+            self.abandoned = True
+            return list(self.usernames)
+
+
+def serve_usernames(model, prompt, count, trace=UNTRACED, collector=None):
+    """Returns (usernames, upstream_calls), serving from the prompt cache and generating only what is missing."""
+    started = time.perf_counter()
+    key = normalize_prompt(prompt)
+    collector = collector or UsernameCollector()
+    usernames = collector.usernames
+    collector.take(key, count)
+    started = trace.add('cache', started)
+    upstream_calls = 0
+    if len(usernames) == count:
+        if username_cache.is_low(key):
+            username_cache.schedule_refill(key, lambda: generate_batch(model, prompt, USERNAME_CACHE_REFILL_SIZE, minimum=1)[0])
+        return usernames, upstream_calls
+
+    deadline_at = time.monotonic() + GEMINI_DEADLINE_SECONDS # For the whole request, hedges and top-ups included
+
+    # Misses for one key share a model call. The leader sizes it for every request still waiting on
+    # the key and stocks the pool; each waiter takes its share from there. A waiter that finds the
+    # pool drained by the others goes round again (becoming the next leader) until the deadline.
+    def take_missing():
+        if len(usernames) < count:
+            _add_demand(key, -collector.take(key, count - len(usernames)))
+        return len(usernames) >= count or collector.abandoned
+
+    def generate():
+        with _pending_demand_lock:
+            demand = _pending_demand.get(key, 0)
+        generated, calls = generate_for_demand(model, prompt, max(1, demand), deadline_at=deadline_at)
+        return calls, len(username_cache.add(key, generated))
+
+    _add_demand(key, count - len(usernames))
+    try:
+        while len(usernames) < count and not collector.abandoned and time.monotonic() < deadline_at:
+            result, ran = model_flights.do(key, generate, ready=take_missing, timeout=deadline_at - time.monotonic())
+            started = trace.add('model_call', started)
+            take_missing()
+            started = trace.add('cache', started)
+            if ran:
+                calls, stocked = result
+                upstream_calls += calls
+                if not stocked:
+                    break # The model only produced names that were already served; another round would not help
+    finally:
+        _add_demand(key, len(usernames) - count)
+    return usernames, upstream_calls
+
+
+# --- Streaming ---
+def sse_event(event, data):
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+def stream_model_usernames(model, prompt, count, exclude=()):
+    """Yields usernames from a streaming generate_content call as soon as each line is complete.
+
+    Holds one in-flight slot for the whole stream; streams are not hedged.
+    """
+    if not _model_call_slots.acquire(timeout=GEMINI_DEADLINE_SECONDS):
+        model_call_stats.incr('slot_timeouts')
+        raise TimeoutError(f"No Gemini call slot became free within {GEMINI_DEADLINE_SECONDS}s")
+    try:
+        model_call_stats.incr('calls')
+        deadline_at = time.monotonic() + GEMINI_DEADLINE_SECONDS
+        response = model.generate_content(build_batch_prompt(prompt, count, exclude=exclude), stream=True,
+                                          request_options={'timeout': GEMINI_DEADLINE_SECONDS})
+        buffer = ''
+        for chunk in response:
+            try:
+                buffer += chunk.text
+            except ValueError: # Chunks without text parts (e.g. the final finish_reason chunk)
+                continue
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                yield from parse_usernames(line)
+            if time.monotonic() > deadline_at:
+                model_call_stats.incr('deadline_expirations')
+                raise TimeoutError(f"Gemini stream did not finish within {GEMINI_DEADLINE_SECONDS}s")
+        yield from parse_usernames(buffer)
+    except Exception:
+        model_call_stats.incr('errors')
+        raise
+    finally:
+        _model_call_slots.release()
+
+
+_STREAM_END = object()
+
+
+def first_item_within(iterator, timeout, spill):
+    """Yields from `iterator`, which runs on its own thread; raises TimeoutError if nothing arrives within `timeout`.
+
+    After a timeout the thread keeps draining the iterator and hands every item to `spill`.
+    """
+    items = queue.Queue()
+    lock = threading.Lock()
+    abandoned = False
+
+    def pump():
+        try:
+            for item in iterator:
+                with lock:
+                    if not abandoned:
+                        items.put(item)
+                        continue
+                spill(item)
+            items.put(_STREAM_END)
+        except Exception as e:
+            items.put(e)
+
+    threading.Thread(target=pump, name="gemini-stream", daemon=True).start()
+    try:
+        item = items.get(timeout=timeout)
+    except queue.Empty:
+        with lock:
+            abandoned = True
+            while not items.empty():
+                item = items.get_nowait()
+                if item is not _STREAM_END and not isinstance(item, Exception):
+                    spill(item)
+        raise TimeoutError(f"No item within {timeout}s")
+    while item is not _STREAM_END:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+        item = items.get()
+
+
+def stream_usernames(model, prompt, count, engine, seed=None):
+    """Yields server-sent events: one 'username' event per name as soon as it is known, then 'done' (or 'error').
+
+    Cached names go out first, then names parsed from the streaming model response.
+    In 'auto' (and 'local') mode any shortfall is filled from the local engine, and in 'auto' mode
+    the first name must arrive within AUTO_ENGINE_LATENCY_BUDGET_SECONDS.
+    """
+    key = normalize_prompt(prompt)
+    sent = []
+    seen = set()
+    upstream_calls = 0
+
+    if engine != ENGINE_LOCAL:
+        try:
+            for username in username_cache.take(key, count):
+                seen.add(username.lower())
+                sent.append(username)
+                yield sse_event('username', username)
+            if len(sent) < count:
+                upstream_calls = 1
+                surplus = []
+                streamed = stream_model_usernames(model, prompt, min(MAX_BATCH_COUNT, count - len(sent) + USERNAME_CACHE_REFILL_SIZE), exclude=list(sent))
+                if engine == ENGINE_AUTO and not sent:
+                    # A stream that misses the budget keeps running; its names stock the prompt cache
+                    streamed = first_item_within(streamed, AUTO_ENGINE_LATENCY_BUDGET_SECONDS,
+                                                 lambda username: is_available(username) and username_cache.add(key, [username]))
+                for username in streamed:
+                    if username.lower() in seen or username_cache.is_served(key, username) or not is_available(username):
+                        continue
+                    seen.add(username.lower())
+                    if len(sent) < count:
+                        username_cache.mark_served(key, [username])
+                        sent.append(username)
+                        yield sse_event('username', username)
+                    else:
+                        surplus.append(username)
+                username_cache.add(key, surplus)
+        except Exception as e:
+            timed_out = isinstance(e, TimeoutError)
+            log('WARNING' if timed_out else 'ERROR', "Streaming from Gemini failed", engine=engine, error=repr(e))
+            if engine == ENGINE_GEMINI:
+                yield sse_event('error', json.dumps({'error': f"An unexpected error occurred in the function: {e}."}))
+                return
+            engine_stats.incr('fallback_timeout' if timed_out else 'fallback_error')
+
+    from_local = 0
+    if len(sent) < count and engine != ENGINE_GEMINI:
+        for username in generate_local(prompt, count + len(sent), seed=seed):
+            if len(sent) == count:
+                break
+            if username.lower() not in seen:
+                sent.append(username)
+                from_local += 1
+                yield sse_event('username', username)
+
+    if not sent:
+        yield sse_event('error', json.dumps({'error': "No username could be generated for the given prompt. Please try a different one."}))
+        return
+    served_by = engine if engine != ENGINE_AUTO else (ENGINE_AUTO if from_local and len(sent) > from_local else ENGINE_LOCAL if from_local else ENGINE_GEMINI)
+    engine_stats.incr(served_by)
+    yield sse_event('done', json.dumps({'count': len(sent), 'upstream_calls': upstream_calls, 'engine': served_by}))
+
+
+# --- Engine selection ---
+local_usernames = LocalUsernameEngine()
+
+
+def generate_local(prompt, count, seed=None):
+    """Local engine output with taken names removed. Draws extra candidates when a filter is configured."""
+    if taken_names is None:
+        return local_usernames.generate(prompt, count, seed=seed)
+    return [u for u in local_usernames.generate(prompt, count * 2 + 8, seed=seed) if is_available(u)][:count]
+
+
+_gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_WORKER_THREADS, thread_name_prefix="gemini")
+_gemini_worker_slots = threading.BoundedSemaphore(GEMINI_WORKER_THREADS) # Held from submit until the worker is done
+engine_stats = Counters('gemini', 'local', 'auto', 'fallback_timeout', 'fallback_error', 'fallback_short', 'fallback_busy')
+
+
+def serve_usernames_auto(model, prompt, count, seed=None, trace=UNTRACED):
+    """Tries Gemini within AUTO_ENGINE_LATENCY_BUDGET_SECONDS and fills any gap from the local engine.
+
+    Returns (usernames, upstream_calls, engine) where engine is the one that produced the response
+    ('auto' when the names came from both). upstream_calls is None when Gemini timed out or failed:
+    the abandoned call may still be running or retrying, so its count is not known.
+    When every worker is busy Gemini is skipped, since a queued call could not start within the budget.
+    """
+    if not _gemini_worker_slots.acquire(blocking=False):
+        log('WARNING', "No Gemini worker is free, using the local engine", workers=GEMINI_WORKER_THREADS)
+        usernames, upstream_calls = [], 0
+        engine_stats.incr('fallback_busy')
+    else:
+        collector = UsernameCollector()
+        # The worker times its stages on its own trace: after a timeout it keeps running while this
+        # request's trace is being emitted, so its stages are only merged once it has finished.
+        worker_trace = RequestTrace(trace.request_id)
+        started = time.perf_counter()
+        future = _gemini_executor.submit(serve_usernames, model, prompt, count, worker_trace, collector)
+        future.add_done_callback(lambda _: _gemini_worker_slots.release()) # Also runs when cancelled
+        try:
+            usernames, upstream_calls = future.result(timeout=AUTO_ENGINE_LATENCY_BUDGET_SECONDS)
+            trace.merge(worker_trace)
+            if len(usernames) == count:
+                return usernames, upstream_calls, ENGINE_GEMINI
+            engine_stats.incr('fallback_short')
+        except FutureTimeoutError:
+            # A running call finishes in its worker, but only stocks the prompt cache from now on
+            future.cancel()
+            usernames, upstream_calls = collector.abandon(), None
+            trace.add('model_call', started)
+            log('WARNING', "Gemini exceeded the latency budget, using the local engine", budget_seconds=AUTO_ENGINE_LATENCY_BUDGET_SECONDS)
+            engine_stats.incr('fallback_timeout')
+        except Exception as e:
+            usernames, upstream_calls = collector.abandon(), None
+            trace.merge(worker_trace)
+            log('ERROR', "Calling Gemini failed, using the local engine", error=repr(e))
+            engine_stats.incr('fallback_error')
+
+    started = time.perf_counter()
+    taken = {u.lower() for u in usernames}
+    local = [u for u in generate_local(prompt, count + len(usernames), seed=seed) if u.lower() not in taken][:count - len(usernames)]
+    trace.add('local_engine', started)
+    return usernames + local, upstream_calls, ENGINE_GEMINI if not local else ENGINE_AUTO if taken else ENGINE_LOCAL
+
+
+def get_stats():
+    """Per-instance counters, returned as JSON for GET requests that carry the stats token."""
+    return {
+        'engine': engine_stats.snapshot(),
+        'model_calls': dict(model_call_stats.snapshot(), p50_seconds=model_latency.percentile(0.5), p95_seconds=model_latency.percentile(HEDGE_PERCENTILE)),
+        'username_cache': username_cache.snapshot_stats(),
+        'rate_limit': rate_limiter.stats.snapshot(),
+        'coalescing': model_flights.stats.snapshot(),
+        'taken_names': dict(taken_names_stats.snapshot(), **(taken_names.stats() if isinstance(taken_names, BloomFilter) else {})),
+        'model_availability': dict(model_availability.stats.snapshot(), available=model_availability.available),
+    }
+
+
 @on_request(
     # No 'secrets' argument here, as we are managing secrets via firebase.json
     region="us-central1", # Recommended to specify a region for your function
+    concurrency=FUNCTION_CONCURRENCY, # Upstream calls run on worker threads, so one container can serve many requests
 )
 def generate_username(request):
+    trace_context = request.headers.get('X-Cloud-Trace-Context')
+    trace = RequestTrace(trace_context.split('/', 1)[0] if trace_context else uuid.uuid4().hex)
+    trace.fields['method'] = request.method
+    result = handle_request(request, trace)
+    status = result.status_code if isinstance(result, Response) else result[1]
+    trace.emit(status)
+    return result
+
+
+def handle_request(request, trace):
     response_headers = {
         'Access-Control-Allow-Origin': 'https://user-name-generator.web.app',
         'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type',
-        'Access-Control-Max-Age': '3600'
+        'Access-Control-Allow-Headers': f'Content-Type, {CLIENT_API_KEY_HEADER}',
+        'Access-Control-Max-Age': '3600',
+        'Access-Control-Expose-Headers': 'X-Upstream-Calls, X-Engine, X-Request-Id',
+        'X-Request-Id': trace.request_id
     }
 
     if request.method == 'OPTIONS':
-        print("Handling OPTIONS preflight request.")
         return ('', 204, response_headers)
 
-    # Access the API key directly from environment variables
-    api_key = os.environ.get(GEMINI_API_KEY_ENV_NAME)
-
-    # --- DEBUGGING LINE: TEMPORARILY PRINT API KEY VALUE TO LOGS ---
-    # WARNING: This exposes your API key in logs. REMOVE AFTER DEBUGGING!
-    # Truncate for display in logs if it's a real key, or just print its presence
-    print(f"DEBUG: Value of GEMINI_API_KEY (first 5 chars): '{api_key[:5] if api_key else 'None'}'")
-    # --- END DEBUGGING LINE ---
-
-    if not api_key:
-        print(f"ERROR: API key '{GEMINI_API_KEY_ENV_NAME}' not configured in environment.")
-        response_headers['Content-Type'] = 'text/plain'
-        return (f"API key not configured. Please ensure {GEMINI_API_KEY_ENV_NAME} is set as a secret and linked to the function via firebase.json.", 500, response_headers)
-
-    genai.configure(api_key=api_key)
-
-    # --- Logging for model availability ---
-    try:
-        print("Attempting to list available Gemini models...")
-        available_models = [m.name for m in genai.list_models()]
-        print(f"Successfully listed models. Total: {len(available_models)}")
-        print(f"Available models: {available_models}")
-        if GEMINI_MODEL_NAME in available_models:
-            print(f"'{GEMINI_MODEL_NAME}' IS present in the list of available models.")
-        else:
-            print(f"'{GEMINI_MODEL_NAME}' IS NOT present in the list of available models. Please check exact model name and API permissions.")
-    except Exception as e:
-        import traceback
-        print(f"ERROR listing models: {e}")
-        print(traceback.format_exc())
-    # --- END Logging ---
-
     if request.method == 'POST':
+        # Checked before any parsing or upstream work, so a limited client costs almost nothing
+        retry_after = rate_limiter.check(client_key(request))
+        if retry_after:
+            response_headers['Retry-After'] = str(math.ceil(retry_after))
+            response_headers['Content-Type'] = 'text/plain'
+            return ("Too many requests. Please slow down and try again shortly.", 429, response_headers)
+
         try:
-            print(f"Received POST request. Content-Type: {request.headers.get('Content-Type')}")
+            started = time.perf_counter()
             request_json = request.get_json(silent=True)
-            print(f"Parsed JSON from request: {request_json}")
 
             if not request_json or 'prompt' not in request_json:
-                print("ERROR: No 'prompt' key found in request JSON or JSON is invalid.")
+                log('WARNING', "No 'prompt' key found in request JSON or JSON is invalid", request_id=trace.request_id)
                 response_headers['Content-Type'] = 'text/plain'
                 return ('Please provide a "prompt" in the request body.', 400, response_headers)
 
             prompt = str(request_json['prompt']).strip()
-            print(f"Extracted and stripped prompt: '{prompt}' (Type: {type(prompt)})")
 
             if not prompt:
-                print("ERROR: Extracted prompt is empty after stripping.")
+                log('WARNING', "Prompt is empty after stripping", request_id=trace.request_id)
                 response_headers['Content-Type'] = 'text/plain'
                 return ('Error: Prompt is empty. Please provide valid content.', 400, response_headers)
 
-            model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-            print(f"Attempting to use Gemini Model: {GEMINI_MODEL_NAME}")
+            count = request_json.get('count')
+            if count is not None:
+                try:
+                    count = int(count) if isinstance(count, (int, str)) and not isinstance(count, bool) else 0
+                except ValueError: # Includes digit-like strings int() rejects, such as '²'
+                    count = 0
+                if not 1 <= count <= MAX_BATCH_COUNT:
+                    response_headers['Content-Type'] = 'text/plain'
+                    return (f'Error: "count" must be an integer between 1 and {MAX_BATCH_COUNT}.', 400, response_headers)
 
-            full_gemini_prompt = (
-                f"Generate 1 unique and creative username based on these keywords/themes: '{prompt}'. "
-                "Keep it concise, single word if possible, and suitable for online use. "
-                "Return only the username, no extra text, numbering, or explanations."
-            )
-            print(f"Sending prompt to Gemini API: '{full_gemini_prompt}'")
+            batch = count is not None
+            count = count or 1
 
-            response = model.generate_content(full_gemini_prompt)
-
-            print(f"Received response from Gemini API: {response}")
-            if response.text:
-                print(f"Gemini response.text: '{response.text}'")
-            else:
-                print("WARNING: Gemini response.text is empty or not available.")
+            engine = str(request_json.get('engine') or os.environ.get(DEFAULT_ENGINE_ENV_NAME) or ENGINE_GEMINI).lower()
+            if engine not in ENGINES:
+                response_headers['Content-Type'] = 'text/plain'
+                return (f'Error: "engine" must be one of {", ".join(ENGINES)}.', 400, response_headers)
 
-            generated_username = response.text.strip()
-            print(f"Generated username after stripping: '{generated_username}'")
+            # Access the API key directly from environment variables
+            api_key = os.environ.get(GEMINI_API_KEY_ENV_NAME)
 
-            if generated_username:
+            if not api_key and engine == ENGINE_AUTO:
+                log('WARNING', "API key not configured, using the local engine", env_name=GEMINI_API_KEY_ENV_NAME)
+                engine = ENGINE_LOCAL
+            elif not api_key and engine == ENGINE_GEMINI:
+                log('ERROR', "API key not configured in environment", env_name=GEMINI_API_KEY_ENV_NAME)
                 response_headers['Content-Type'] = 'text/plain'
-                return (generated_username, 200, response_headers)
+                return (f"API key not configured. Please ensure {GEMINI_API_KEY_ENV_NAME} is set as a secret and linked to the function via firebase.json.", 500, response_headers)
+
+            stream = request_json.get('stream') is True # Strings such as "false" do not turn streaming on
+            trace.fields.update(engine=engine, count=count, stream=stream)
+            if log_level <= LOG_LEVELS['DEBUG']:
+                log('DEBUG', "Parsed request", request_id=trace.request_id, prompt=prompt, prompt_key=normalize_prompt(prompt))
+            started = trace.add('parse', started)
+
+            model = None
+            if engine != ENGINE_LOCAL:
+                model = get_model(api_key)
+                model_availability.get() # Cached; schedules a background refresh when stale
+
+            if stream:
+                response_headers['Content-Type'] = 'text/event-stream'
+                response_headers['Cache-Control'] = 'no-cache'
+                return Response(stream_usernames(model, prompt, count, engine, seed=request_json.get('seed')), 200, response_headers)
+
+            if engine == ENGINE_LOCAL:
+                usernames, upstream_calls = generate_local(prompt, count, seed=request_json.get('seed')), 0
+                trace.add('local_engine', started)
+            elif engine == ENGINE_AUTO:
+                usernames, upstream_calls, engine = serve_usernames_auto(model, prompt, count, seed=request_json.get('seed'), trace=trace)
             else:
-                print("ERROR: No username could be extracted from Gemini response text.")
+                usernames, upstream_calls = serve_usernames(model, prompt, count, trace=trace)
+            started = time.perf_counter()
+            engine_stats.incr(engine)
+            trace.fields.update(engine=engine, upstream_calls=upstream_calls, returned=len(usernames))
+            if upstream_calls is not None: # Left out when the count is unknown (auto-mode fallback)
+                response_headers['X-Upstream-Calls'] = str(upstream_calls)
+            response_headers['X-Engine'] = engine
+
+            if not usernames:
+                log('ERROR', "No username could be extracted from Gemini response text", request_id=trace.request_id)
                 response_headers['Content-Type'] = 'text/plain'
                 return ("No username could be generated for the given prompt. Please try a different one.", 500, response_headers)
+            if batch:
+                response_headers['Content-Type'] = 'application/json'
+                body = json.dumps(usernames)
+            else:
+                response_headers['Content-Type'] = 'text/plain'
+                body = usernames[0]
+            trace.add('postprocess', started)
+            return (body, 200, response_headers)
 
         except Exception as e:
             import traceback
-            print(f"UNCAUGHT EXCEPTION IN POST handler: {e}")
-            print(traceback.format_exc())
+            log('ERROR', "Uncaught exception in POST handler", request_id=trace.request_id, error=repr(e), traceback=traceback.format_exc())
             response_headers['Content-Type'] = 'text/plain'
             return (f"An unexpected error occurred in the function: {e}. Please check Cloud Function logs for details.", 500, response_headers)
 
+    elif request.method == 'GET' and os.environ.get(STATS_TOKEN_ENV_NAME):
+        # Stats reveal traffic and quota usage, so they are only served to operators
+        expected = f"Bearer {os.environ[STATS_TOKEN_ENV_NAME]}".encode('utf-8')
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'), expected):
+            response_headers['Content-Type'] = 'text/plain'
+            response_headers['WWW-Authenticate'] = 'Bearer'
+            return ("Unauthorized", 401, response_headers)
+        response_headers['Content-Type'] = 'application/json'
+        response_headers['Cache-Control'] = 'no-store'
+        return (json.dumps(get_stats()), 200, response_headers)
+
     else:
-        print(f"Received unsupported HTTP method: {request.method}")
         response_headers['Content-Type'] = 'text/plain'
         return ("Method Not Allowed", 405, response_headers)
-    
\ No newline at end of file
@@ -0,0 +1,189 @@
+"""Compact probabilistic index of usernames that are already taken.
+
+A Bloom filter stored in a single file: a fixed header followed by the bit
+array. Loading memory-maps the file read-only, so a cold start costs one
+mmap() call no matter how many names the filter holds; pages are faulted in
+as lookups touch them. Names are compared case-insensitively.
+
+False positives (an available name reported as taken) happen at roughly the
+rate the filter was built for; false negatives never do.
+
+Usage:
+    python taken_names.py build taken.txt taken.bloom --fp-rate 0.001
+    python taken_names.py update taken.bloom new_signups.txt
+"""
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+MAGIC = b'UNBF'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQQ') # magic, version, num_hashes, num_bits, count, capacity
+DEFAULT_FP_RATE = 0.001
+
+
+def _hashes(name):
+    digest = hashlib.blake2b(name.lower().encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+
+def read_dump(path):
+    """Yields one name per non-empty line of a dump file."""
+    with open(path, encoding='utf-8') as dump:
+        for line in dump:
+            name = line.strip()
+            if name:
+                yield name
+
+
+class BloomFilter:
+    """Bloom filter over lowercased names, using double hashing of a 128-bit blake2b digest."""
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0, capacity=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self.capacity = capacity
+        self._bits = bytearray((num_bits + 7) // 8) if bits is None else bits
+        self._mmap = None
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate=DEFAULT_FP_RATE):
+        """An empty filter sized so that `capacity` names give a false positive rate of about `fp_rate`."""
+        capacity = max(1, capacity)
+        num_bits = max(8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes, capacity=capacity)
+
+    @classmethod
+    def from_dump(cls, path, fp_rate=DEFAULT_FP_RATE, capacity=None):
+        """Builds a filter from a dump file with one name per line."""
+        if capacity is None:
+            capacity = sum(1 for _ in read_dump(path))
+        bloom = cls.for_capacity(capacity, fp_rate)
+        bloom.update(read_dump(path))
+        return bloom
+
+    @classmethod
+    def load(cls, path, writable=False):
+        """Opens a saved filter. Read-only filters are memory-mapped; writable ones are copied into memory."""
+        with open(path, 'rb') as f:
+            if writable:
+                data = f.read()
+            elif os.fstat(f.fileno()).st_size < HEADER.size:
+                data = b'' # mmap() refuses empty files; the length check below rejects it
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(data) < HEADER.size:
+                raise ValueError(f"{path} is too short to be a taken-names filter")
+            magic, version, num_hashes, num_bits, count, capacity = HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a taken-names filter (version {VERSION})")
+            if len(data) < HEADER.size + (num_bits + 7) // 8:
+                raise ValueError(f"{path} is truncated")
+        except ValueError:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            raise
+        if writable:
+            bits = bytearray(data[HEADER.size:])
+        else:
+            bits = memoryview(data)[HEADER.size:]
+        bloom = cls(num_bits, num_hashes, bits=bits, count=count, capacity=capacity)
+        if not writable:
+            bloom._mmap = data
+        return bloom
+
+    def save(self, path):
+        """Writes the filter atomically, so instances that have the old file mapped are unaffected."""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.num_hashes, self.num_bits, self.count, self.capacity))
+            f.write(self._bits)
+        os.replace(tmp_path, path)
+
+    def add(self, name):
+        h1, h2 = _hashes(name)
+        bits = self._bits
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % self.num_bits
+            bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def update(self, names):
+        """Adds names in bulk; returns how many were added."""
+        added = 0
+        for name in names:
+            self.add(name)
+            added += 1
+        return added
+
+    def __contains__(self, name):
+        h1, h2 = _hashes(name)
+        bits = self._bits
+        num_bits = self.num_bits
+        for i in range(self.num_hashes):
+            bit = (h1 + i * h2) % num_bits
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def size_bytes(self):
+        return HEADER.size + len(self._bits)
+
+    def expected_fp_rate(self):
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    def stats(self):
+        return {
+            'names': self.count,
+            'capacity': self.capacity,
+            'size_bytes': self.size_bytes,
+            'num_hashes': self.num_hashes,
+            'expected_fp_rate': round(self.expected_fp_rate(), 6),
+        }
+
+
+def update_file(filter_path, dump_path):
+    """Adds every name in `dump_path` to the filter stored at `filter_path`; returns how many were added."""
+    bloom = BloomFilter.load(filter_path, writable=True)
+    added = bloom.update(read_dump(dump_path))
+    bloom.save(filter_path)
+    return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or update a taken-usernames Bloom filter.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="build a new filter from a dump file (one name per line)")
+    build.add_argument('dump')
+    build.add_argument('output')
+    build.add_argument('--fp-rate', type=float, default=DEFAULT_FP_RATE)
+    build.add_argument('--capacity', type=int, help="names the filter should hold (defaults to the dump size; leave room for updates)")
+    update = commands.add_parser('update', help="add the names from a dump file to an existing filter")
+    update.add_argument('filter')
+    update.add_argument('dump')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        bloom = BloomFilter.from_dump(args.dump, fp_rate=args.fp_rate, capacity=args.capacity)
+        bloom.save(args.output)
+        print(f"Wrote {args.output}: {bloom.stats()}")
+    else:
+        added = update_file(args.filter, args.dump)
+        bloom = BloomFilter.load(args.filter)
+        print(f"Added {added} names to {args.filter}: {bloom.stats()}")
+        if bloom.count > bloom.capacity:
+            print("WARNING: the filter holds more names than it was sized for; rebuild it with a larger --capacity.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""Prompt-keyed pools of generated usernames.
+
+Each function instance keeps bounded pools in memory. Given a shared backend
+(FirestorePoolBackend), surplus names are stored there instead so every instance
+draws from the same pool. InMemoryPoolBackend implements the same interface and
+stands in for Firestore locally and in tests.
+
+A backend implements:
+    take(key, count, now) -> list of up to `count` usernames, removed from the pool
+    add(key, usernames, expires_at)
+`now` and `expires_at` are wall-clock time (time.time()) so they are comparable across instances.
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from counters import Counters
+
+
+def normalize_prompt(prompt):
+    """Cache key for a prompt: case, whitespace and keyword order are ignored."""
+    keywords = re.split(r'[\s,;/|]+', prompt.lower())
+    return ' '.join(sorted(set(keyword for keyword in keywords if keyword)))
+
+
+class InMemoryPoolBackend:
+    """Pool backend for a single process, backed by a dict."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def take(self, key, count, now):
+        with self._lock:
+            usernames, expires_at = self._pools.get(key, ([], 0))
+            if expires_at < now:
+                self._pools.pop(key, None)
+                return []
+            self._pools[key] = (usernames[count:], expires_at)
+            return usernames[:count]
+
+    def add(self, key, usernames, expires_at):
+        with self._lock:
+            existing, _ = self._pools.get(key, ([], 0))
+            self._pools[key] = (existing + [u for u in usernames if u not in existing], expires_at)
+
+
+class FirestorePoolBackend:
+    """Stores username pools in Firestore so every function instance draws from the same pool."""
+
+    def __init__(self, collection='username_pools', client=None):
+        from firebase_admin import firestore
+        self._firestore = firestore
+        self._client = client or firestore.client()
+        self._collection = collection
+
+    def _document(self, key):
+        # Keys can contain characters Firestore does not allow in document ids
+        return self._client.collection(self._collection).document(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def take(self, key, count, now):
+        doc_ref = self._document(key)
+
+        @self._firestore.transactional
+        def take_in_transaction(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            data = snapshot.to_dict() if snapshot.exists else None
+            if not data or data.get('expires_at', 0) < now:
+                return []
+            usernames = data.get('usernames', [])
+            transaction.update(doc_ref, {'usernames': usernames[count:]})
+            return usernames[:count]
+
+        return take_in_transaction(self._client.transaction())
+
+    def add(self, key, usernames, expires_at):
+        self._document(key).set({
+            'prompt_key': key,
+            'usernames': self._firestore.ArrayUnion(list(usernames)),
+            'expires_at': expires_at,
+        }, merge=True)
+
+
+class UsernamePoolCache:
+    """Bounded per-instance pools of generated usernames, keyed by normalized prompt.
+
+    Names are handed out at most once per pool lifetime. Pools expire after `ttl_seconds`
+    (extended whenever names are added) and the least recently used key is evicted beyond
+    `max_keys`. An optional shared `backend` is consulted when the local pool runs dry, and
+    receives surplus names. Backend and refill failures are reported to `log_error(message, **fields)`.
+    """
+
+    def __init__(self, max_keys, ttl_seconds, backend=None, refill_size=20, low_watermark=5, log_error=None):
+        self.max_keys = max_keys
+        self.ttl_seconds = ttl_seconds
+        self.backend = backend
+        self.refill_size = refill_size
+        self.low_watermark = low_watermark
+        self.log_error = log_error or (lambda message, **fields: None)
+        self._lock = threading.Lock()
+        self._pools = OrderedDict() # key -> [usernames, served_lowercase, expires_at (monotonic)]
+        self._refilling = set()
+        self.stats = Counters('hits', 'partial_hits', 'misses', 'evictions', 'expirations',
+                              'backend_hits', 'backend_misses', 'backend_errors', 'refills')
+
+    def _entry(self, key):
+        """Returns the live pool for `key` (creating it if needed). Caller must hold the lock."""
+        entry = self._pools.get(key)
+        if entry is not None and entry[2] < time.monotonic():
+            del self._pools[key]
+            self.stats.incr('expirations')
+            entry = None
+        if entry is None:
+            entry = [[], set(), time.monotonic() + self.ttl_seconds]
+            self._pools[key] = entry
+            while len(self._pools) > self.max_keys:
+                self._pools.popitem(last=False)
+                self.stats.incr('evictions')
+        self._pools.move_to_end(key)
+        return entry
+
+    def take(self, key, count):
+        """Pops up to `count` never-served usernames for `key`."""
+        with self._lock:
+            entry = self._entry(key)
+            usernames = entry[0][:count]
+            del entry[0][:count]
+            entry[1].update(u.lower() for u in usernames)
+
+        if len(usernames) < count and self.backend is not None:
+            try:
+                shared = self.backend.take(key, count - len(usernames) + self.refill_size, time.time())
+            except Exception as e:
+                shared = []
+                self.stats.incr('backend_errors')
+                self.log_error("Reading shared username cache failed", error=repr(e))
+            self.stats.incr('backend_hits' if shared else 'backend_misses')
+            with self._lock:
+                entry = self._entry(key)
+                fresh = [u for u in shared if u.lower() not in entry[1]]
+                served = fresh[:count - len(usernames)]
+                entry[1].update(u.lower() for u in served)
+                entry[0].extend(fresh[len(served):])
+            usernames += served
+
+        if not usernames:
+            self.stats.incr('misses')
+        else:
+            self.stats.incr('hits' if len(usernames) == count else 'partial_hits')
+        return usernames
+
+    def add(self, key, usernames):
+        """Stocks the pool with generated names that have not been served yet; returns the ones accepted."""
+        with self._lock:
+            entry = self._entry(key)
+            entry[2] = time.monotonic() + self.ttl_seconds # Like the backend, whose expires_at is rewritten on every add
+            known = entry[1] | {u.lower() for u in entry[0]}
+            fresh = []
+            for username in usernames:
+                if username.lower() not in known:
+                    known.add(username.lower())
+                    fresh.append(username)
+            if self.backend is None:
+                entry[0].extend(fresh)
+        if fresh and self.backend is not None:
+            try:
+                self.backend.add(key, fresh, time.time() + self.ttl_seconds)
+            except Exception as e:
+                self.stats.incr('backend_errors')
+                self.log_error("Writing shared username cache failed", error=repr(e))
+                with self._lock:
+                    self._entry(key)[0].extend(fresh)
+        return fresh
+
+    def mark_served(self, key, usernames):
+        with self._lock:
+            self._entry(key)[1].update(u.lower() for u in usernames)
+
+    def is_served(self, key, username):
+        with self._lock:
+            return username.lower() in self._entry(key)[1]
+
+    def is_low(self, key):
+        with self._lock:
+            entry = self._pools.get(key)
+            return self.backend is None and (entry is None or len(entry[0]) < self.low_watermark)
+
+    def schedule_refill(self, key, generate):
+        """Runs `generate()` on a background thread (once per key at a time) and stocks the pool with its result."""
+        with self._lock:
+            if key in self._refilling:
+                return
+            self._refilling.add(key)
+
+        def refill():
+            try:
+                self.add(key, generate())
+                self.stats.incr('refills')
+            except Exception as e:
+                self.log_error("Refilling username cache failed", prompt_key=key, error=repr(e))
+            finally:
+                with self._lock:
+                    self._refilling.discard(key)
+
+        threading.Thread(target=refill, name="username-cache-refill", daemon=True).start()
+
+    def snapshot_stats(self):
+        stats = self.stats.snapshot()
+        lookups = stats['hits'] + stats['partial_hits'] + stats['misses']
+        return dict(stats, keys=len(self._pools), hit_ratio=round(stats['hits'] / lookups, 4) if lookups else None)
@@ -0,0 +1,163 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from coordination import FirestoreCoordinationStore, InMemoryCoordinationStore, SingleFlight, TokenBucketLimiter
+
+
+class FailingStore:
+    def consume_token(self, key, capacity, refill_per_second, now):
+        raise ConnectionError("store down")
+
+
+def test_token_bucket_allows_burst_then_limits():
+    limiter = TokenBucketLimiter(capacity=3, refill_per_second=1)
+    assert [limiter.check('client') for _ in range(3)] == [0, 0, 0]
+    wait_seconds = limiter.check('client')
+    assert 0 < wait_seconds <= 1
+    assert limiter.check('other') == 0 # Buckets are per client
+    assert limiter.stats.snapshot() == {'allowed': 4, 'limited': 1, 'store_errors': 0}
+
+
+def test_token_bucket_refills_over_time():
+    store = InMemoryCoordinationStore()
+    assert store.consume_token('client', 1, 2, now=100.0) == 0
+    assert store.consume_token('client', 1, 2, now=100.1) > 0
+    assert store.consume_token('client', 1, 2, now=100.7) == 0
+
+
+def test_token_bucket_store_is_bounded():
+    store = InMemoryCoordinationStore(max_keys=2)
+    for client in ('a', 'b', 'c'):
+        store.consume_token(client, 1, 1, now=0)
+    assert store.consume_token('a', 1, 1, now=0) == 0 # 'a' was evicted, so it starts with a full bucket
+
+
+def test_token_bucket_fails_open():
+    limiter = TokenBucketLimiter(capacity=1, refill_per_second=1, store=FailingStore())
+    assert limiter.check('client') == 0
+    assert limiter.stats['store_errors'] == 1
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flights = SingleFlight()
+    calls = []
+    barrier = threading.Barrier(10)
+
+    def work():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    def caller(_):
+        barrier.wait()
+        return flights.do('key', work)
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(caller, range(10)))
+    assert len(calls) == 1
+    assert all(result == 'result' for result, _ in results)
+    assert sum(ran for _, ran in results) == 1
+    assert flights.stats.snapshot()['coalesced'] == 9
+
+
+def test_single_flight_shares_errors_and_forgets_finished_flights():
+    flights = SingleFlight()
+
+    def fail():
+        raise RuntimeError("upstream failed")
+
+    with pytest.raises(RuntimeError):
+        flights.do('key', fail)
+    assert flights.do('key', lambda: 'retried') == ('retried', True)
+
+
+def test_single_flight_waits_on_another_instance_lease():
+    store = InMemoryCoordinationStore()
+    store.acquire_lease('key', 10, time.time()) # Held by "another instance"
+    flights = SingleFlight(store=store, lease_seconds=10, poll_seconds=0.01)
+    polls = []
+
+    def ready():
+        polls.append(1)
+        return len(polls) >= 3
+
+    assert flights.do('key', lambda: 'should not run', ready=ready) == (None, False)
+    assert flights.stats['remote_coalesced'] == 1
+
+
+def test_single_flight_takes_over_an_expired_lease():
+    store = InMemoryCoordinationStore()
+    store.acquire_lease('key', 0.05, time.time())
+    flights = SingleFlight(store=store, lease_seconds=10, poll_seconds=0.01)
+    assert flights.do('key', lambda: 'ran', ready=lambda: False) == ('ran', True)
+    assert store.acquire_lease('key', 10, time.time()) # Released after the call
+
+
+def test_single_flight_follower_gives_up_after_its_timeout():
+    flights = SingleFlight()
+    release = threading.Event()
+    leader = threading.Thread(target=flights.do, args=('key', release.wait))
+    leader.start()
+    time.sleep(0.05)
+    started = time.monotonic()
+    assert flights.do('key', lambda: 'should not run', timeout=0.1) == (None, False)
+    assert time.monotonic() - started < 0.5
+    assert flights.stats['wait_timeouts'] == 1
+    release.set()
+    leader.join()
+
+
+def test_single_flight_stops_polling_a_lease_after_its_timeout():
+    store = InMemoryCoordinationStore()
+    store.acquire_lease('key', 10, time.time())
+    flights = SingleFlight(store=store, lease_seconds=10, poll_seconds=0.01)
+    assert flights.do('key', lambda: 'should not run', ready=lambda: False, timeout=0.05) == (None, False)
+    assert flights.stats['wait_timeouts'] == 1
+
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeDocument:
+    def __init__(self, documents, path):
+        self._documents = documents
+        self.path = path
+
+    def get(self, transaction=None):
+        return FakeSnapshot(self._documents.get(self.path))
+
+
+class FakeFirestoreClient:
+    """Just enough of a Firestore client for FirestoreCoordinationStore.consume_token()."""
+
+    def __init__(self):
+        self.documents = {}
+
+    def collection(self, name):
+        return SimpleNamespace(document=lambda document_id: FakeDocument(self.documents, f'{name}/{document_id}'))
+
+    def transaction(self):
+        return SimpleNamespace(set=lambda doc_ref, data: self.documents.__setitem__(doc_ref.path, data))
+
+
+def test_firestore_buckets_expire_once_full_again():
+    client = FakeFirestoreClient()
+    store = FirestoreCoordinationStore(client=client)
+    store._firestore = SimpleNamespace(transactional=lambda fn: fn)
+
+    assert store.consume_token('client', 3, 0.5, now=1000.0) == 0
+    assert store.consume_token('client', 3, 0.5, now=1000.0) == 0
+    (bucket,) = client.documents.values()
+    assert bucket['tokens'] == 1
+    assert bucket['expires_at'] == datetime.fromtimestamp(1004.0, tz=timezone.utc) # Two tokens at 0.5/s
@@ -0,0 +1,27 @@
+from local_engine import MAX_USERNAME_LENGTH, LocalUsernameEngine, candidate_parts, prompt_keywords
+
+
+def test_same_seed_gives_the_same_names():
+    engine = LocalUsernameEngine()
+    first = engine.generate('space cats', 20, seed=7)
+    assert first == LocalUsernameEngine().generate('Cats space', 20, seed=7)
+    assert first != engine.generate('space cats', 20, seed=8)
+    assert LocalUsernameEngine(seed=1).generate('space cats', 20) == LocalUsernameEngine(seed=1).generate('space cats', 20)
+
+
+def test_names_are_unique_and_valid():
+    usernames = LocalUsernameEngine(seed=1).generate('retro gaming neon pixel wizard dragon', 500)
+    assert len(usernames) == 500
+    assert len({u.lower() for u in usernames}) == 500
+    assert all(3 <= len(u) <= MAX_USERNAME_LENGTH and u.replace('_', '').isalnum() for u in usernames)
+
+
+def test_regions_cover_the_unit_interval():
+    regions = candidate_parts(prompt_keywords('space cats'))
+    assert len(regions) == 4 # Keyword heads and keyword tails, each with a leetspeak twin
+    assert regions[0][1] == 0.0 and regions[-1][0] == 1.0
+    assert all(previous[0] == region[1] for previous, region in zip(regions, regions[1:]))
+
+
+def test_prompt_without_keywords_still_generates():
+    assert len(LocalUsernameEngine(seed=1).generate('!!', 5)) == 5
@@ -0,0 +1,435 @@
+import itertools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask, request
+
+import main
+from coordination import SingleFlight
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    """Returns as many fresh names as the prompt asks for, after `latency` seconds."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = 0
+        self._names = itertools.count()
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, **kwargs):
+        requested = int(re.search(r'Generate (\d+)', contents).group(1))
+        with self._lock:
+            self.calls += 1
+            names = [f'Name{next(self._names)}' for _ in range(requested)]
+        time.sleep(self.latency)
+        return StubResponse('\n'.join(names))
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(main, 'username_cache', main.UsernamePoolCache(main.USERNAME_CACHE_MAX_KEYS, main.USERNAME_CACHE_TTL_SECONDS))
+    monkeypatch.setattr(main, 'model_flights', SingleFlight())
+    monkeypatch.setattr(main, '_pending_demand', {})
+    monkeypatch.setattr(main, 'rate_limiter', main.TokenBucketLimiter(main.RATE_LIMIT_BURST, main.RATE_LIMIT_REFILL_PER_SECOND))
+
+
+@pytest.fixture
+def stub_genai(monkeypatch):
+    genai = StubGenai()
+    monkeypatch.setattr(main, 'genai', genai)
+    monkeypatch.setattr(main, '_model', None)
+    monkeypatch.setattr(main, '_configured_api_key', None)
+    monkeypatch.setattr(main, 'model_availability', main.ModelAvailabilityCache(main.GEMINI_MODEL_NAME, 60))
+    monkeypatch.setenv(main.GEMINI_API_KEY_ENV_NAME, 'test-key')
+    return genai
+
+
+class StubGenai:
+    """Stands in for google.generativeai: counts configure() calls, models built and list_models() calls."""
+
+    def __init__(self, listed=(main.GEMINI_MODEL_NAME,)):
+        self.listed = listed
+        self.configured = []
+        self.models_built = 0
+        self.list_calls = 0
+
+    def configure(self, api_key):
+        self.configured.append(api_key)
+
+    def GenerativeModel(self, name):
+        self.models_built += 1
+        return StubModel()
+
+    def list_models(self):
+        self.list_calls += 1
+        return [SimpleNamespace(name=name) for name in self.listed]
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_get_model_configures_once_per_api_key(stub_genai):
+    genai = stub_genai
+    model = main.get_model('key-1')
+    assert main.get_model('key-1') is model
+    assert (genai.configured, genai.models_built) == (['key-1'], 1)
+
+    assert main.get_model('key-2') is not model
+    assert (genai.configured, genai.models_built) == (['key-1', 'key-2'], 2)
+    assert main.model_availability.stats['invalidations'] == 2
+
+
+def test_model_availability_is_refreshed_off_the_request_path(monkeypatch):
+    genai = StubGenai()
+    monkeypatch.setattr(main, 'genai', genai)
+    cache = main.ModelAvailabilityCache(main.GEMINI_MODEL_NAME, ttl_seconds=0.2)
+
+    assert cache.get() is None # Unknown until the background refresh completes
+    wait_until(lambda: cache.available is not None)
+    assert cache.get() is True and cache.get() is True
+    assert genai.list_calls == 1
+    assert (cache.stats['misses'], cache.stats['hits'], cache.stats['refreshes']) == (1, 2, 1)
+
+    genai.listed = ('models/other',)
+    time.sleep(0.25)
+    assert cache.get() is True # Stale value is served while the refresh runs
+    wait_until(lambda: cache.available is False)
+    assert genai.list_calls == 2
+
+    cache.invalidate()
+    assert cache.available is None and cache.stats['invalidations'] == 1
+
+
+def post(body):
+    with Flask(__name__).test_request_context('/', method='POST', json=body):
+        return main.generate_username(request)
+
+
+def get_stats_response(headers):
+    with Flask(__name__).test_request_context('/', method='GET', headers=headers):
+        return main.generate_username(request)
+
+
+def test_stats_are_not_public(monkeypatch):
+    monkeypatch.setenv(main.GEMINI_API_KEY_ENV_NAME, 'test-key')
+    monkeypatch.delenv(main.STATS_TOKEN_ENV_NAME, raising=False)
+    assert get_stats_response({})[1] == 405
+
+    monkeypatch.setenv(main.STATS_TOKEN_ENV_NAME, 's3cret')
+    assert get_stats_response({})[1] == 401
+    assert get_stats_response({'Authorization': 'Bearer wrong'})[1] == 401
+    body, status, _ = get_stats_response({'Authorization': 'Bearer s3cret'})
+    assert status == 200
+    assert 'model_availability' in main.json.loads(body)
+
+
+def test_auto_fallback_does_not_invent_an_upstream_call_count(monkeypatch):
+    monkeypatch.setattr(main, 'AUTO_ENGINE_LATENCY_BUDGET_SECONDS', 0.05)
+    usernames, calls, engine = main.serve_usernames_auto(StubModel(latency=0.3), 'space cats', 3, seed=1)
+    assert len(usernames) == 3 and engine == main.ENGINE_LOCAL
+    assert calls is None
+
+
+def test_abandoned_auto_run_does_not_touch_the_request_trace(monkeypatch):
+    monkeypatch.setattr(main, 'AUTO_ENGINE_LATENCY_BUDGET_SECONDS', 0.05)
+    trace = main.RequestTrace('abandoned')
+    main.serve_usernames_auto(StubModel(latency=0.2), 'frozen lakes', 3, seed=1, trace=trace)
+    stages = dict(trace.stages)
+    assert set(stages) == {'model_call', 'local_engine'}
+    time.sleep(0.4) # The worker finishes its model call after the request was answered
+    assert trace.stages == stages
+
+
+def test_auto_trace_includes_the_worker_stages_within_budget(monkeypatch):
+    monkeypatch.setattr(main, 'AUTO_ENGINE_LATENCY_BUDGET_SECONDS', 1.0)
+    trace = main.RequestTrace('within-budget')
+    _, _, engine = main.serve_usernames_auto(StubModel(), 'frozen lakes', 3, trace=trace)
+    assert engine == main.ENGINE_GEMINI
+    assert {'cache', 'model_call'} <= set(trace.stages)
+
+
+def test_abandoned_auto_run_only_stocks_the_pool(monkeypatch):
+    monkeypatch.setattr(main, 'AUTO_ENGINE_LATENCY_BUDGET_SECONDS', 0.05)
+    usernames, _, engine = main.serve_usernames_auto(StubModel(latency=0.2), 'desert foxes', 3, seed=1)
+    assert len(usernames) == 3 and engine == main.ENGINE_LOCAL
+
+    time.sleep(0.4)
+    stocked = main.username_cache.take(main.normalize_prompt('desert foxes'), 100)
+    assert len(stocked) == 3 + main.USERNAME_CACHE_REFILL_SIZE # Nothing was taken for the request that gave up
+
+
+def test_auto_skips_gemini_when_no_worker_is_free(monkeypatch):
+    monkeypatch.setattr(main, 'AUTO_ENGINE_LATENCY_BUDGET_SECONDS', 0.05)
+    monkeypatch.setattr(main, '_gemini_executor', ThreadPoolExecutor(max_workers=2))
+    monkeypatch.setattr(main, '_gemini_worker_slots', threading.BoundedSemaphore(2))
+    model = StubModel(latency=0.2)
+    busy_before = main.engine_stats['fallback_busy']
+    barrier = threading.Barrier(6)
+
+    def request(i):
+        barrier.wait()
+        return main.serve_usernames_auto(model, f'prompt {i}', 3, seed=i)
+
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        results = list(pool.map(request, range(6)))
+
+    assert all(len(usernames) == 3 for usernames, _, _ in results)
+    assert main.engine_stats['fallback_busy'] - busy_before == 4
+    assert [calls for _, calls, _ in results].count(0) == 4
+    time.sleep(0.4)
+    assert model.calls == 2
+
+
+@pytest.mark.parametrize('engine, served_by', [('gemini', 'gemini'), ('LOCAL', 'local'), ('auto', 'gemini')])
+def test_engine_field_picks_the_engine(stub_genai, engine, served_by):
+    body, status, headers = post({'prompt': 'space cats', 'count': 2, 'engine': engine, 'seed': 1})
+    assert status == 200
+    assert headers['X-Engine'] == served_by # A Gemini answer within the budget serves 'auto' requests
+    assert len(main.json.loads(body)) == 2
+
+
+def test_unknown_engine_is_rejected(stub_genai):
+    body, status, _ = post({'prompt': 'space cats', 'engine': 'openai'})
+    assert status == 400
+    assert '"engine"' in body
+
+
+def test_auto_without_api_key_uses_the_local_engine(monkeypatch):
+    monkeypatch.delenv(main.GEMINI_API_KEY_ENV_NAME, raising=False)
+    body, status, headers = post({'prompt': 'space cats', 'count': 3, 'engine': 'auto', 'seed': 1})
+    assert status == 200
+    assert headers['X-Engine'] == main.ENGINE_LOCAL and headers['X-Upstream-Calls'] == '0'
+    assert main.json.loads(body) == main.local_usernames.generate('space cats', 3, seed=1)
+
+    _, status, _ = post({'prompt': 'space cats', 'engine': 'gemini'})
+    assert status == 500
+
+
+class FirstCallSlowModel:
+    """The first call takes `delay` seconds, later ones answer at once."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, **kwargs):
+        with self._lock:
+            self.calls += 1
+            first = self.calls == 1
+        if first:
+            time.sleep(self.delay)
+        return StubResponse('\n'.join(f'Hedge{i}' for i in range(int(re.search(r'Generate (\d+)', contents).group(1)))))
+
+
+def test_call_model_counts_hedged_calls(monkeypatch):
+    monkeypatch.setattr(main, 'hedge_delay', lambda: 0.05)
+    model = FirstCallSlowModel(delay=0.5)
+    usernames, calls = main.generate_batch(model, 'space cats', 5)
+    assert len(usernames) == 5
+    assert calls == model.calls == 2
+
+    _, calls = main.call_model(model, main.build_batch_prompt('space cats', 5))
+    assert calls == 1
+
+
+def test_parse_usernames_drops_markers_quotes_and_invalid_entries():
+    text = '1. NeonFox\n2) "PixelWolf"\n- `CyberHawk`\n* StarLynx, MoonOwl\n\u2022 \'SkyRay\'\nHere are some names:\n\n'
+    assert main.parse_usernames(text) == ['NeonFox', 'PixelWolf', 'CyberHawk', 'StarLynx', 'MoonOwl', 'SkyRay']
+    assert main.parse_usernames(None) == []
+
+
+class FixedModel:
+    """Answers every call with the same `text`."""
+
+    def __init__(self, text):
+        self.text = text
+        self.calls = 0
+
+    def generate_content(self, contents, **kwargs):
+        self.calls += 1
+        return StubResponse(self.text)
+
+
+def test_generate_batch_dedupes_case_insensitively():
+    usernames, _ = main.generate_batch(FixedModel('NeonFox\nneonfox\nPixelWolf\nNEONFOX\nCyberHawk'), 'space cats', 3)
+    assert usernames == ['NeonFox', 'PixelWolf', 'CyberHawk']
+
+
+def test_generate_batch_stops_after_the_top_up_limit():
+    model = FixedModel('NeonFox\nPixelWolf')
+    usernames, calls = main.generate_batch(model, 'space cats', 5)
+    assert usernames == ['NeonFox', 'PixelWolf']
+    assert calls == model.calls == 1 + main.MAX_BATCH_TOP_UP_CALLS
+
+
+@pytest.mark.parametrize('count', [0, main.MAX_BATCH_COUNT + 1, -1, '\u00b2', 'three', '', 2.5, True, [3]])
+def test_invalid_count_is_rejected(stub_genai, count):
+    body, status, _ = post({'prompt': 'space cats', 'count': count})
+    assert status == 400
+    assert '"count"' in body
+
+
+def test_batch_request_returns_a_json_array(stub_genai):
+    body, status, headers = post({'prompt': 'space cats', 'count': '3'})
+    assert status == 200
+    assert headers['Content-Type'] == 'application/json'
+    usernames = main.json.loads(body)
+    assert len(usernames) == 3 and all(main.USERNAME_PATTERN.match(u) for u in usernames)
+    assert headers['X-Upstream-Calls'] == '1'
+
+    body, status, headers = post({'prompt': 'space cats'})
+    assert status == 200 and headers['Content-Type'] == 'text/plain'
+    assert body not in usernames
+
+
+class SlowFixedModel(FixedModel):
+    def __init__(self, text, latency):
+        super().__init__(text)
+        self.latency = latency
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency)
+        return super().generate_content(contents, **kwargs)
+
+
+def test_top_up_limit_counts_attempts_not_hedges(monkeypatch):
+    monkeypatch.setattr(main, 'hedge_delay', lambda: 0.01)
+    usernames, calls = main.generate_batch(SlowFixedModel('NeonFox', latency=0.05), 'space cats', 5)
+    assert usernames == ['NeonFox']
+    assert calls == 2 * (1 + main.MAX_BATCH_TOP_UP_CALLS) # Every attempt was hedged
+
+
+def test_serve_usernames_keeps_to_the_request_deadline(monkeypatch):
+    monkeypatch.setattr(main, 'hedge_delay', lambda: 10)
+    monkeypatch.setattr(main, 'GEMINI_DEADLINE_SECONDS', 0.3)
+    started = time.monotonic()
+    usernames, calls = main.serve_usernames(SlowFixedModel('NeonFox', latency=0.2), 'space cats', 5)
+    assert time.monotonic() - started < 0.45
+    assert usernames == ['NeonFox'] # The top-up that ran out of time did not discard the first call's name
+    assert calls == 2
+
+
+class SlowStreamModel:
+    """Streams `names` one per chunk, after an initial `delay`."""
+
+    def __init__(self, names, delay):
+        self.names = names
+        self.delay = delay
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        def chunks():
+            time.sleep(self.delay)
+            for name in self.names:
+                yield StubResponse(name + '\n')
+        return chunks()
+
+
+def stream_events(model, count, engine):
+    events = []
+    for event in main.stream_usernames(model, 'ocean waves', count, engine, seed=1):
+        kind, data = event.strip().split('\n')
+        events.append((kind[len('event: '):], data[len('data: '):]))
+    return events
+
+
+def test_auto_stream_falls_back_to_local_within_budget(monkeypatch):
+    monkeypatch.setattr(main, 'AUTO_ENGINE_LATENCY_BUDGET_SECONDS', 0.1)
+    model = SlowStreamModel(['SlowName1', 'SlowName2'], delay=0.5)
+    started = time.monotonic()
+    events = stream_events(model, 3, main.ENGINE_AUTO)
+    assert time.monotonic() - started < 0.4
+    assert [kind for kind, _ in events] == ['username'] * 3 + ['done']
+    assert main.json.loads(events[-1][1])['engine'] == main.ENGINE_LOCAL
+
+    # The abandoned stream still stocks the prompt cache
+    time.sleep(0.6)
+    assert main.username_cache.take(main.normalize_prompt('ocean waves'), 2) == ['SlowName1', 'SlowName2']
+
+
+def test_auto_stream_within_budget_uses_gemini(monkeypatch):
+    monkeypatch.setattr(main, 'AUTO_ENGINE_LATENCY_BUDGET_SECONDS', 1.0)
+    events = stream_events(SlowStreamModel(['FastName1', 'FastName2'], delay=0.0), 2, main.ENGINE_AUTO)
+    assert [data for kind, data in events[:2]] == ['FastName1', 'FastName2']
+    assert main.json.loads(events[-1][1])['engine'] == main.ENGINE_GEMINI
+
+
+@pytest.mark.parametrize('stream', ['false', 'true', 1, None])
+def test_only_json_true_turns_streaming_on(stub_genai, stream):
+    body, status, headers = post({'prompt': 'space cats', 'count': 2, 'stream': stream})
+    assert status == 200 and headers['Content-Type'] == 'application/json'
+    assert len(main.json.loads(body)) == 2
+
+
+def test_stream_true_returns_server_sent_events(stub_genai):
+    response = post({'prompt': 'space cats', 'count': 2, 'stream': True, 'engine': 'local', 'seed': 1})
+    assert response.status_code == 200 and response.mimetype == 'text/event-stream'
+    events = [line.split(': ', 1)[1] for line in response.get_data(as_text=True).splitlines() if line.startswith('event: ')]
+    assert events == ['username', 'username', 'done']
+
+
+def test_cache_hit_makes_no_model_call():
+    model = StubModel()
+    first, calls = main.serve_usernames(model, 'space cats', 5)
+    assert len(first) == 5 and calls == 1
+    second, calls = main.serve_usernames(model, 'Cats  SPACE', 5)
+    assert len(second) == 5 and calls == 0
+    assert not {u.lower() for u in first} & {u.lower() for u in second}
+
+
+def test_burst_of_misses_serves_every_request():
+    model = StubModel(latency=0.2)
+    barrier = threading.Barrier(40)
+
+    def request(_):
+        barrier.wait()
+        return main.serve_usernames(model, 'space cats', 10)
+
+    with ThreadPoolExecutor(max_workers=40) as pool:
+        results = list(pool.map(request, range(40)))
+
+    served = [name.lower() for usernames, _ in results for name in usernames]
+    assert all(len(usernames) == 10 for usernames, _ in results)
+    assert len(served) == len(set(served)) == 400
+    assert sum(calls for _, calls in results) == model.calls
+    assert model.calls <= 20
+    assert main._pending_demand == {}
+
+
+class FakeRequest:
+    def __init__(self, headers, remote_addr='10.0.0.9'):
+        self.headers = headers
+        self.remote_addr = remote_addr
+
+
+def test_client_key_uses_last_forwarded_for_entry():
+    assert main.client_key(FakeRequest({'X-Forwarded-For': '1.2.3.4, 203.0.113.7'})) == 'ip:203.0.113.7'
+    assert main.client_key(FakeRequest({})) == 'ip:10.0.0.9'
+
+
+def test_client_key_ignores_unknown_api_keys(monkeypatch):
+    known = main.hashlib.sha256(b'known-key').hexdigest()
+    monkeypatch.setattr(main, 'client_api_key_digests', frozenset([known]))
+    assert main.client_key(FakeRequest({'X-API-Key': 'known-key'})) == 'key:' + known
+    assert main.client_key(FakeRequest({'X-API-Key': 'made-up', 'X-Forwarded-For': '203.0.113.7'})) == 'ip:203.0.113.7'
+
+
+def test_shared_coordination_requires_the_shared_pool(monkeypatch):
+    monkeypatch.setenv(main.COORDINATION_BACKEND_ENV_NAME, 'firestore')
+    monkeypatch.delenv(main.USERNAME_CACHE_BACKEND_ENV_NAME, raising=False)
+    with pytest.raises(ValueError, match=main.USERNAME_CACHE_BACKEND_ENV_NAME):
+        main._create_coordination_store()
@@ -0,0 +1,61 @@
+import pytest
+
+from taken_names import HEADER, BloomFilter, update_file
+
+
+def test_no_false_negatives_and_case_insensitive():
+    bloom = BloomFilter.for_capacity(1000, 0.01)
+    names = [f'user{i}' for i in range(1000)]
+    assert bloom.update(names) == 1000
+    assert all(name in bloom for name in names)
+    assert 'USER42' in bloom
+    assert len(bloom) == 1000
+
+
+def test_false_positive_rate_near_target():
+    bloom = BloomFilter.for_capacity(5000, 0.01)
+    bloom.update(f'taken{i}' for i in range(5000))
+    false_positives = sum(1 for i in range(20000) if f'free{i}' in bloom)
+    assert false_positives / 20000 < 0.03
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = tmp_path / 'taken.bloom'
+    bloom = BloomFilter.for_capacity(100)
+    bloom.update(['NeonFox', 'PixelWolf'])
+    bloom.save(str(path))
+
+    mapped = BloomFilter.load(str(path))
+    assert 'neonfox' in mapped and 'PixelWolf' in mapped
+    assert mapped.stats() == bloom.stats()
+    with pytest.raises(TypeError):
+        mapped.add('ReadOnly') # Memory-mapped read-only
+
+
+def test_update_file_adds_names(tmp_path):
+    path = tmp_path / 'taken.bloom'
+    dump = tmp_path / 'new.txt'
+    BloomFilter.for_capacity(100).save(str(path))
+    dump.write_text('NeonFox\n\nPixelWolf\n')
+
+    assert update_file(str(path), str(dump)) == 2
+    bloom = BloomFilter.load(str(path))
+    assert 'NeonFox' in bloom and 'PixelWolf' in bloom and len(bloom) == 2
+
+
+@pytest.mark.parametrize('content', [b'', b'UNBF', b'NOPE' + bytes(HEADER.size)])
+def test_load_rejects_invalid_files(tmp_path, content):
+    path = tmp_path / 'bad.bloom'
+    path.write_bytes(content)
+    with pytest.raises(ValueError):
+        BloomFilter.load(str(path))
+    with pytest.raises(ValueError):
+        BloomFilter.load(str(path), writable=True)
+
+
+def test_load_rejects_truncated_bit_array(tmp_path):
+    path = tmp_path / 'taken.bloom'
+    BloomFilter.for_capacity(1000).save(str(path))
+    path.write_bytes(path.read_bytes()[:HEADER.size + 10])
+    with pytest.raises(ValueError, match='truncated'):
+        BloomFilter.load(str(path))
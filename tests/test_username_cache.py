@@ -0,0 +1,78 @@
+import time
+
+from username_cache import InMemoryPoolBackend, UsernamePoolCache, normalize_prompt
+
+
+class FailingBackend:
+    def take(self, key, count, now):
+        raise ConnectionError("backend down")
+
+    def add(self, key, usernames, expires_at):
+        raise ConnectionError("backend down")
+
+
+def test_normalize_prompt_ignores_case_order_and_separators():
+    assert normalize_prompt('Space  Cats') == normalize_prompt('cats, space') == 'cats space'
+
+
+def test_names_are_served_at_most_once():
+    cache = UsernamePoolCache(max_keys=10, ttl_seconds=60)
+    assert cache.add('k', ['NeonFox', 'PixelWolf', 'neonfox']) == ['NeonFox', 'PixelWolf']
+    assert cache.take('k', 1) == ['NeonFox']
+    assert cache.add('k', ['NEONFOX', 'CyberHawk']) == ['CyberHawk']
+    assert cache.take('k', 5) == ['PixelWolf', 'CyberHawk']
+    assert cache.take('k', 5) == []
+    assert cache.is_served('k', 'pixelwolf')
+    stats = cache.snapshot_stats()
+    assert (stats['hits'], stats['partial_hits'], stats['misses']) == (1, 1, 1)
+
+
+def test_least_recently_used_key_is_evicted():
+    cache = UsernamePoolCache(max_keys=2, ttl_seconds=60)
+    cache.add('a', ['A1'])
+    cache.add('b', ['B1'])
+    cache.take('a', 0) # Touches 'a', so 'b' is now least recently used
+    cache.add('c', ['C1'])
+    assert cache.take('a', 1) == ['A1']
+    assert cache.take('c', 1) == ['C1']
+    assert cache.take('b', 1) == []
+    assert cache.snapshot_stats()['evictions'] == 2 # 'b', then 'a' to make room for the empty 'b' pool
+
+
+def test_expired_pool_is_discarded_with_its_served_set():
+    cache = UsernamePoolCache(max_keys=10, ttl_seconds=0.05)
+    cache.add('k', ['NeonFox', 'PixelWolf'])
+    assert cache.take('k', 1) == ['NeonFox']
+    time.sleep(0.1)
+    assert cache.take('k', 1) == []
+    assert cache.snapshot_stats()['expirations'] == 1
+    assert cache.add('k', ['NeonFox']) == ['NeonFox'] # A new pool lifetime may serve it again
+
+
+def test_adding_names_extends_the_pool_lifetime():
+    cache = UsernamePoolCache(max_keys=10, ttl_seconds=0.1)
+    cache.add('k', ['NeonFox'])
+    time.sleep(0.06)
+    cache.add('k', ['PixelWolf'])
+    time.sleep(0.06)
+    assert cache.take('k', 2) == ['NeonFox', 'PixelWolf']
+    assert cache.snapshot_stats()['expirations'] == 0
+
+
+def test_instances_share_a_backend_pool_without_repeats():
+    backend = InMemoryPoolBackend()
+    first = UsernamePoolCache(max_keys=10, ttl_seconds=60, backend=backend)
+    second = UsernamePoolCache(max_keys=10, ttl_seconds=60, backend=backend)
+    first.add('k', [f'Name{i}' for i in range(60)])
+
+    served = first.take('k', 5) + second.take('k', 5) + first.take('k', 5) + second.take('k', 5)
+    assert len(served) == len(set(served)) == 20
+    assert second.snapshot_stats()['backend_hits'] >= 1
+
+
+def test_backend_failure_falls_back_to_the_local_pool():
+    cache = UsernamePoolCache(max_keys=10, ttl_seconds=60, backend=FailingBackend())
+    assert cache.add('k', ['NeonFox', 'PixelWolf']) == ['NeonFox', 'PixelWolf']
+    assert cache.take('k', 2) == ['NeonFox', 'PixelWolf']
+    assert cache.take('k', 1) == []
+    assert cache.snapshot_stats()['backend_errors'] == 2